@@ -0,0 +1,109 @@
+import argparse
+import contextlib
+import io
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from nx.core.tcp_transfer import receive_file_tcp  # noqa: E402
+
+DEFAULT_CHUNKS = [4, 64, 1024]  # kb
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_test_file(path, size_mb):
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(os.urandom(1024 * 1024))
+
+
+def run(file_path, save_dir, chunk, hash_algo):
+    """
+    Send a file over loopback with the receiver on a thread of this process and the
+    sender in a subprocess, so only the receive path is measured.
+    Returns a tuple of (wall seconds, receiver CPU seconds).
+    """
+    port = free_port()
+    result = {}
+
+    def receive():
+        start = time.thread_time()
+        for _ in receive_file_tcp(port, save_dir, chunk, hash_algo=hash_algo):
+            pass
+        result["cpu"] = time.thread_time() - start
+
+    receiver = threading.Thread(target=receive)
+    with contextlib.redirect_stdout(io.StringIO()):
+        receiver.start()
+        time.sleep(0.5)  # let the receiver start listening
+        start = time.perf_counter()
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "nx.cli.cli_main",
+                "post",
+                "file",
+                "127.0.0.1",
+                str(port),
+                file_path,
+                "--chunk",
+                str(chunk),
+                "--hash",
+                hash_algo,
+            ],
+            cwd=ROOT,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+        receiver.join()
+        wall = time.perf_counter() - start
+    return wall, result["cpu"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the CPU time nx spends receiving a file over loopback."
+    )
+    parser.add_argument("--size", type=int, default=256, help="File size in mb.")
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        nargs="+",
+        default=DEFAULT_CHUNKS,
+        help="Chunk sizes in kb.",
+    )
+    parser.add_argument("--hash", default="none", help="Hash algorithm. Default none.")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per chunk size.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file_path = os.path.join(tmp, "data.bin")
+        write_test_file(file_path, args.size)
+        save_dir = os.path.join(tmp, "received")
+        print(f"{'chunk':>8} {'seconds':>8} {'mb/s':>8} {'cpu s':>8} {'cpu s/gb':>9}")
+        for chunk in args.chunk:
+            # the fastest run is the least disturbed by other processes
+            wall, cpu = min(
+                run(file_path, save_dir, chunk, args.hash) for _ in range(args.runs)
+            )
+            print(
+                f"{chunk:>6}kb {wall:>8.2f} {args.size / wall:>8.1f} {cpu:>8.2f}"
+                f" {cpu * 1024 / args.size:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
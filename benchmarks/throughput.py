@@ -0,0 +1,19 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from nx.cli.cli_parser import build_parser  # noqa: E402
+
+
+def main():
+    """
+    Same as `nx bench`, for a checkout without nx installed. Takes the same options.
+    """
+    args = build_parser().parse_args(["bench", *sys.argv[1:]])
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
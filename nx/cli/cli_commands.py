@@ -1,6 +1,16 @@
+import asyncio
+import glob
+import os
+import sys
+import tempfile
+
 import nx.core.utilities as utils
+from nx.core import aio, bench
+from nx.core.metrics import TransferMetrics
 from nx.core.msg_transfer import receive_messages, send_messages  # noqa: F401
-from nx.core.tcp_transfer import receive_file_tcp, send_file_tcp
+from nx.core.protocol import ProtocolError
+from nx.core.tcp_transfer import receive_file_tcp, send_file_tcp, serve_files_tcp
+from nx.core.tuning import AUTO
 
 
 def get_local_ip(*args, **kwargs):
@@ -8,15 +18,78 @@ def get_local_ip(*args, **kwargs):
     print(f"{ip}")
 
 
+def expand_paths(patterns):
+    """
+    Expand globs the shell left alone, and read paths from stdin for "-".
+    Paths that exist are taken as they are, even if they look like a glob.
+    """
+    paths = []
+    for pattern in patterns:
+        if pattern == "-":
+            paths += [line.rstrip("\r\n") for line in sys.stdin if line.strip()]
+        elif os.path.exists(pattern) or not glob.has_magic(pattern):
+            paths.append(pattern)  # e.g. a file named "[1].txt"
+        else:
+            paths += sorted(glob.glob(pattern)) or [pattern]
+    return paths
+
+
+def new_meter(side, path):
+    """
+    Metrics of a transfer that are written to a JSON file when it ends, or None
+    without a path.
+    """
+    if path is None:
+        return None
+
+    def write_summary(event, fields):
+        if event == "transfer_end":
+            utils.write_json(path, fields)
+            print(f"\nMetrics written to {path}.")
+
+    return TransferMetrics(side, hooks=[write_summary])
+
+
 def send_file(args):
     ip = args.ip
     port = args.port
-    file_path = args.file_path
+    file_path = expand_paths(args.file_path)
     verbose = args.verbose
     chunk = args.chunk
     zip_mode = args.zip
+    zero_copy = not args.no_sendfile
+    inline_hash = args.inline_hash
+    hash_algo = args.hash
+    streams = args.streams
+    resume = args.resume
+    tar_mode = args.tar
+    compress = args.compress
+    jobs = args.jobs
+    delta_mode = args.delta
+    dedup_mode = args.dedup
+    sync_mode = args.sync
+    read_ahead = args.read_ahead
+    meter = new_meter("sender", args.metrics_json)
     for progress in send_file_tcp(
-        ip, port, file_path, chunk, zip_mode, verbose=verbose
+        ip,
+        port,
+        file_path,
+        chunk,
+        zip_mode,
+        verbose=verbose,
+        zero_copy=zero_copy,
+        inline_hash=inline_hash,
+        hash_algo=hash_algo,
+        streams=streams,
+        resume=resume,
+        tar_mode=tar_mode,
+        compress=compress,
+        jobs=jobs,
+        delta_mode=delta_mode,
+        dedup_mode=dedup_mode,
+        sync_mode=sync_mode,
+        read_ahead=read_ahead,
+        meter=meter,
     ):
         utils.print_progress(
             progress["current"],
@@ -24,6 +97,8 @@ def send_file(args):
             title="Sending",
             verbose=verbose,
             unit="auto",
+            speed=progress.get("speed"),
+            eta=progress.get("eta"),
         )
 
 
@@ -35,12 +110,130 @@ def recieve_file(args):
         verbose = True
     else:
         verbose = False
+    hash_algo = args.hash
+    cache_size = args.cache_size * 1024 * 1024  # convert to bytes
     print(f"Local IP: {utils.get_local_ip()}")
-    for progress in receive_file_tcp(port, file_dir, chunk, verbose=verbose):
+    if args.engine == "asyncio":
+        receive_files_async(args, verbose)
+        return
+    if args.serve:
+        serve_files(args, verbose, cache_size)
+        return
+    for progress in receive_file_tcp(
+        port,
+        file_dir,
+        chunk,
+        verbose=verbose,
+        hash_algo=hash_algo,
+        cache_size=cache_size,
+        write_behind=args.write_behind,
+        meter=new_meter("receiver", args.metrics_json),
+    ):
         utils.print_progress(
             progress["current"],
             progress["total"],
             title="Receiving",
             verbose=verbose,
             unit="auto",
+            speed=progress.get("speed"),
+            eta=progress.get("eta"),
+        )
+
+
+def serve_files(args, verbose, cache_size):
+    try:
+        for progress in serve_files_tcp(
+            args.port,
+            args.file_dir,
+            args.chunk,
+            verbose=verbose,
+            hash_algo=args.hash,
+            workers=args.workers,
+            cache_size=cache_size,
+            write_behind=args.write_behind,
+        ):
+            if progress.get("done"):
+                continue
+            utils.print_progress(
+                progress["current"],
+                progress["total"],
+                title=f"Receiving {progress['name']}",
+                verbose=verbose,
+                unit="auto",
+                speed=progress.get("speed"),
+                eta=progress.get("eta"),
+            )
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+
+
+def receive_files_async(args, verbose):
+    """
+    Receive with the asyncio engine, one transfer or any number of them with --serve.
+    """
+    chunk = aio.DEFAULT_CHUNK if args.chunk == AUTO else args.chunk * 1024
+
+    def print_progress(progress):
+        utils.print_progress(
+            progress["current"],
+            progress["total"],
+            title=f"Receiving {progress['name']}",
+            verbose=verbose,
+            unit="auto",
+            speed=progress.get("speed"),
+            eta=progress.get("eta"),
+        )
+
+    print(f"Listening on port {args.port}...")
+    try:
+        if args.serve:
+            server = aio.serve_files(
+                args.port, args.file_dir, chunk, args.hash, print_progress
+            )
+            asyncio.run(server)
+            return
+        error = asyncio.run(
+            aio.receive_file(args.port, args.file_dir, chunk, args.hash, print_progress)
+        )
+    except KeyboardInterrupt:
+        print("\nServer stopped.")
+        return
+    except (OSError, EOFError, ProtocolError) as e:
+        error = e
+    if error is not None:
+        print(f"\nFile transfer failed: {error}")
+    else:
+        print("\nFile received.")
+
+
+def run_benchmarks(args):
+    report = {**bench.system_info(), "results": []}
+    print(
+        f"{'dataset':>8} {'size':>10} {'chunk':>6} {'hash':>7} {'zip':>4}"
+        f" {'seconds':>8} {'mb/s':>8} {'cpu s':>11} {'rss mb':>11}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        results = bench.run_suite(
+            args.dir or tmp,
+            args.datasets,
+            args.sizes,
+            args.chunks,
+            args.hash,
+            (False, True) if args.zip else (False,),
+            args.runs,
         )
+        for result in results:
+            report["results"].append(result)
+            size = utils.convert_byte(result["size"], "auto")
+            cpu = result["cpu_seconds"]
+            rss = result["peak_rss_mb"]
+            print(
+                f"{result['dataset']:>8} {f'{size[0]} {size[1]}':>10}"
+                f" {result['chunk']:>6} {result['hash']:>7}"
+                f" {'yes' if result['zip'] else 'no':>4}"
+                f" {result['seconds']:>8.2f} {result['mb_s']:>8.1f}"
+                f" {cpu['sender'] or 0:>5.2f}/{cpu['receiver'] or 0:<5.2f}"
+                f" {rss['sender'] or 0:>5.0f}/{rss['receiver'] or 0:<5.0f}"
+            )
+    utils.write_json(args.output, report)
+    print(f"Results written to {args.output}.")
@@ -2,6 +2,7 @@
 from nx.core import utilities as utils
 
 from . import cli_parser as cli
+from . import cli_profile
 
 manifest = utils.read_manifest()
 
@@ -12,6 +13,8 @@ def main():
 
     if args.version:
         print(f"{manifest['version']}")
+    elif hasattr(args, "func") and args.profile:
+        cli_profile.run_profiled(args.func, args, args.profile_output, args.profiler)
     elif hasattr(args, "func"):
         args.func(args)
     else:
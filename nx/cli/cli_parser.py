@@ -4,15 +4,32 @@ from nx.cli.cli_commands import (
     get_local_ip,
     receive_messages,
     recieve_file,
+    run_benchmarks,
     send_file,
     send_messages,
 )
-from nx.core.utilities import read_manifest
+from nx.cli.cli_profile import PROFILERS
+from nx.core.bench import DATASETS, DEFAULT_CHUNKS, DEFAULT_HASHES, DEFAULT_SIZES
+from nx.core.compression import COMPRESS_CHOICES, DEFAULT_JOBS
+from nx.core.dedup import DEFAULT_STORE_SIZE
+from nx.core.pipeline import DEFAULT_DEPTH
+from nx.core.tcp_transfer import SERVE_WORKERS
+from nx.core.tuning import AUTO
+from nx.core.utilities import HASH_CHOICES, read_manifest
+
+
+def chunk_size(value):
+    if value == AUTO:
+        return value
+    return int(value)
 
 
 def build_parser():
     parser = argparse.ArgumentParser(description=f"Network Data Exchanger (nx-cli) v{read_manifest()['version']}")
     parser.add_argument('-v', '--version', action='store_true', help='Print version')
+    parser.add_argument('--profile', action='store_true', help='Run the command under a profiler, save the profile and print the functions of the transfer hot paths that took the most time.')
+    parser.add_argument('--profiler', type=str, choices=PROFILERS, default='auto', help='Profiler used with --profile. Default auto uses the sampling profiler pyinstrument when it is installed, otherwise cProfile.')
+    parser.add_argument('--profile-output', type=str, metavar='PATH', help='File the profile is saved to. Default nx-profile.speedscope.json for pyinstrument and nx-profile.pstats for cProfile.')
     subparsers = parser.add_subparsers(dest='command')
 
     # Get local IP command parser
@@ -33,9 +50,22 @@ def build_parser():
     post_file_parser = post_subparsers.add_parser('file', help='Send files as binary')
     post_file_parser.add_argument('ip', type=str, help='Target IP address')
     post_file_parser.add_argument('port', type=int, help='Port number')
-    post_file_parser.add_argument('file_path', type=str, help='File path to send')
-    post_file_parser.add_argument('-c', '--chunk', type=int, help='Chunk size in kb for file transfer. Default 4. Recommended between 4 to 64 kb.', default=4)
-    post_file_parser.add_argument('-z', '--zip', action='store_true', help='Zip before sending. Only works for directories.')
+    post_file_parser.add_argument('file_path', type=str, nargs='+', help='File or directory paths to send. Several paths are sent over one connection. Globs are expanded, and - reads paths from stdin, one per line.')
+    post_file_parser.add_argument('-c', '--chunk', type=chunk_size, help='Chunk size in kb for file transfer. Default auto, which sizes chunks and socket buffers from the round trip time and throughput measured on the link.', default=AUTO)
+    post_file_parser.add_argument('-z', '--zip', action='store_true', help='Zip before sending instead of sending the files one by one. Only works for directories.')
+    post_file_parser.add_argument('-t', '--tar', action='store_true', help='Stream a directory as a single tar archive, packed while sending and unpacked while receiving. Only works for directories.')
+    post_file_parser.add_argument('--no-sendfile', action='store_true', help='Disable kernel zero-copy sendfile and use a buffered read/send loop instead.')
+    post_file_parser.add_argument('--inline-hash', action='store_true', help='Hash the file while sending and send the hash as a trailer, so the file is only read once. Disables zero-copy sendfile.')
+    post_file_parser.add_argument('--hash', type=str, choices=HASH_CHOICES, default='auto', help='Hash algorithm used to validate the transfer. Default auto. Use none to skip hashing on trusted networks.')
+    post_file_parser.add_argument('--streams', type=int, help='Number of parallel TCP connections used to send a large file. Default 1.', default=1)
+    post_file_parser.add_argument('--compress', type=str, choices=COMPRESS_CHOICES, default='none', help='Compress the data inline while sending. Default none. auto picks the best codec both sides support and skips data that is already compressed.')
+    post_file_parser.add_argument('-j', '--jobs', type=int, default=DEFAULT_JOBS, help='Number of threads compressing data in parallel with --compress. Default is the number of CPU cores.')
+    post_file_parser.add_argument('--delta', action='store_true', help='Only send the parts of a file that differ from the copy the receiver already has.')
+    post_file_parser.add_argument('--dedup', action='store_true', help='Split a file into content-defined chunks and only send the chunks missing from the receiver\'s chunk cache.')
+    post_file_parser.add_argument('--sync', action='store_true', help='Only send the files whose size, modification time or hash differ from the receiver\'s copy. Hashes are kept in an index on both sides, so unchanged files are not hashed again.')
+    post_file_parser.add_argument('--read-ahead', type=int, default=DEFAULT_DEPTH, help='Number of chunks read from disk ahead of the network on a separate thread. Default 4. Use 0 to read and send in turn.')
+    post_file_parser.add_argument('--resume', action='store_true', help='Resume an interrupted transfer from where the receiver left off.')
+    post_file_parser.add_argument('--metrics-json', type=str, metavar='PATH', help='Write timings of the transfer phases, bytes moved, and the number of socket and disk calls with the time spent blocked in them to a JSON file.')
     post_file_parser.add_argument('--verbose', action='store_true', help='Print verbose output')
     post_file_parser.set_defaults(func=send_file)
 
@@ -53,8 +83,27 @@ def build_parser():
     get_file_parser = get_subparsers.add_parser('file', help='Receive files as binary')
     get_file_parser.add_argument('port', type=int, help='Port number')
     get_file_parser.add_argument('file_dir', type=str, help='File directory to save to')
-    get_file_parser.add_argument('-c', '--chunk', type=int, help='Chunk size in kb for file transfer. Default 4. Recommended between 4 to 64.', default=4)
+    get_file_parser.add_argument('-c', '--chunk', type=chunk_size, help='Chunk size in kb for file transfer. Default auto, which sizes chunks and socket buffers from the round trip time and throughput measured on the link.', default=AUTO)
+    get_file_parser.add_argument('--hash', type=str, choices=HASH_CHOICES, default='auto', help='Hash algorithm accepted for validation. Default auto accepts any supported algorithm. Use none to skip validation.')
+    get_file_parser.add_argument('--serve', action='store_true', help='Keep receiving files from any number of senders at once until stopped with Ctrl+C.')
+    get_file_parser.add_argument('--engine', type=str, choices=['threads', 'asyncio'], default='threads', help='Receive engine. asyncio receives every transfer on one event loop instead of a thread each, for many senders at once. It handles single files and directories, but not multiple streams, tar, delta, dedup or sync transfers. Default threads.')
+    get_file_parser.add_argument('--workers', type=int, default=SERVE_WORKERS, help='Number of transfers received at the same time with --serve. Default 8.')
+    get_file_parser.add_argument('--cache-size', type=int, default=DEFAULT_STORE_SIZE // (1024 * 1024), help='Size limit in mb of the chunk cache used by --dedup transfers. Least recently used chunks are removed first. Default 1024.')
+    get_file_parser.add_argument('--write-behind', type=int, default=DEFAULT_DEPTH, help='Number of chunks written to disk behind the network on a separate thread. Default 4. Use 0 to receive and write in turn.')
+    get_file_parser.add_argument('--metrics-json', type=str, metavar='PATH', help='Write timings of the transfer phases, bytes moved, and the number of socket and disk calls with the time spent blocked in them to a JSON file. Not used with --serve.')
     get_file_parser.add_argument('--verbose', action='store_true', help='Print verbose output')
     get_file_parser.set_defaults(func=recieve_file)
 
+    # Benchmark command parser
+    bench_parser = subparsers.add_parser('bench', help='Measure transfer throughput over loopback')
+    bench_parser.add_argument('--datasets', type=str, nargs='+', choices=DATASETS, default=DATASETS, help='Generated data to send: random is an incompressible file, text a compressible file and many a directory of 16 kb files. Default all.')
+    bench_parser.add_argument('--sizes', type=str, nargs='+', default=DEFAULT_SIZES, help='Dataset sizes such as 1K, 100M or 10G. Default 1K 1M 100M.')
+    bench_parser.add_argument('--chunks', type=str, nargs='+', default=DEFAULT_CHUNKS, help='Chunk sizes in kb, or auto. Default 64 1024 auto.')
+    bench_parser.add_argument('--hash', type=str, nargs='+', choices=HASH_CHOICES, default=DEFAULT_HASHES, help='Hash algorithms. Default none auto.')
+    bench_parser.add_argument('-z', '--zip', action='store_true', help='Also send directories zipped.')
+    bench_parser.add_argument('--runs', type=int, default=1, help='Runs per case, the fastest is kept. Default 1.')
+    bench_parser.add_argument('--dir', type=str, help='Directory the datasets are generated in and kept for later runs. Default a temporary directory.')
+    bench_parser.add_argument('-o', '--output', type=str, default='nx-bench.json', help='JSON file the results are written to. Default nx-bench.json.')
+    bench_parser.set_defaults(func=run_benchmarks)
+
     return parser
\ No newline at end of file
@@ -0,0 +1,85 @@
+import cProfile
+import os
+import pstats
+import re
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+PROFILERS = ["auto", "cprofile", "pyinstrument"]
+# the hot paths of a transfer the summary is about
+FOCUS = r"tcp_transfer\.py|\bget_hash\b|\bzip_dir\b|\bprint_progress\b"
+TOP_FUNCTIONS = 20
+
+
+def run_profiled(func, args, output=None, profiler="auto"):
+    """
+    Run a command under a profiler, then save the profile and print the functions
+    of the hot paths that took the most time. The sampling profiler pyinstrument
+    is used when it's installed, and saves a speedscope file. cProfile saves a
+    pstats file. Only the main thread is profiled.
+    """
+    if profiler == "auto":
+        profiler = "pyinstrument" if pyinstrument is not None else "cprofile"
+    if profiler == "pyinstrument":
+        if pyinstrument is None:
+            print("pyinstrument is not installed. Install nx[profile].")
+            return
+        run_pyinstrument(func, args, output or "nx-profile.speedscope.json")
+    else:
+        run_cprofile(func, args, output or "nx-profile.pstats")
+
+
+def run_cprofile(func, args, output):
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(func, args)
+    except KeyboardInterrupt:
+        pass  # e.g. a receive server stopped with Ctrl+C
+    finally:
+        profile.dump_stats(output)
+        print(f"\nProfile written to {output}. Open it with python -m pstats.")
+        stats = pstats.Stats(profile).strip_dirs().sort_stats("cumulative")
+        stats.print_stats(FOCUS, TOP_FUNCTIONS)
+
+
+def run_pyinstrument(func, args, output):
+    from pyinstrument.renderers import SpeedscopeRenderer
+
+    profiler = pyinstrument.Profiler()
+    profiler.start()
+    try:
+        func(args)
+    except KeyboardInterrupt:
+        pass  # e.g. a receive server stopped with Ctrl+C
+    finally:
+        session = profiler.stop()
+        with open(output, "w") as f:
+            f.write(profiler.output(SpeedscopeRenderer()))
+        print(f"\nProfile written to {output}. Open it on https://www.speedscope.app.")
+        print_frame_summary(session.root_frame(), session.duration)
+
+
+def print_frame_summary(root, duration):
+    """
+    Print the cumulative time of the hot path functions in a pyinstrument frame
+    tree. Time spent in recursive calls is only counted once.
+    """
+    focus = re.compile(FOCUS)
+    totals = {}
+
+    def walk(frame, active):
+        name = f"{os.path.basename(frame.file_path or '')}:{frame.function}"
+        if name not in active and focus.search(name):
+            totals[name] = totals.get(name, 0) + frame.time
+        for child in frame.children:
+            walk(child, active | {name})
+
+    if root is not None:
+        walk(root, frozenset())
+    print(f"{'seconds':>8} {'share':>6}  function")
+    top = sorted(totals.items(), key=lambda item: item[1], reverse=True)
+    for name, seconds in top[:TOP_FUNCTIONS]:
+        print(f"{seconds:>8.3f} {seconds / max(duration, 1e-9):>6.1%}  {name}")
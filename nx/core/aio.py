@@ -0,0 +1,422 @@
+import asyncio
+import json
+import os
+
+from . import compression, protocol
+from . import utilities as utils
+from .progress import ProgressReporter
+from .tcp_transfer import (
+    SENDFILE_BLOCK,
+    check_hash,
+    get_supported_hash_algos,
+    resolve_codec,
+    resolve_hash_algo,
+)
+
+# asyncio transfer engine. It speaks the same framed protocol as tcp_transfer, so
+# either side can talk to the blocking engine, but every transfer is a coroutine and
+# hundreds of them can share one event loop instead of a thread each.
+# Single files, natively sent directories and zipped directories are supported.
+# Multi-stream sessions and tar streams are left to the blocking engine.
+# Disk I/O and hashing run on worker threads with asyncio.to_thread, so a slow disk
+# doesn't stall the other transfers on the loop.
+
+DEFAULT_CHUNK = 1024 * 64  # bytes read per step when data isn't sent with sendfile
+REJECT_TIMEOUT = 5  # seconds to wait for more data from a rejected sender
+
+
+def read_data(f, size, hasher=None):
+    data = f.read(size)
+    if hasher is not None:
+        hasher.update(data)
+    return data
+
+
+def write_data(f, data, hasher=None):
+    if hasher is not None:
+        hasher.update(data)
+    f.write(data)
+
+
+def set_attributes(path, entry):
+    os.chmod(path, entry["mode"] & 0o777)
+    os.utime(path, (entry["mtime"], entry["mtime"]))
+
+
+async def send_frame(writer, frame_type, payload=b"", flags=0):
+    writer.write(protocol.pack_header(frame_type, len(payload), flags) + payload)
+    await writer.drain()
+
+
+async def send_json(writer, frame_type, data):
+    await send_frame(writer, frame_type, json.dumps(data).encode())
+
+
+async def recv_header(reader):
+    return protocol.unpack_header(await reader.readexactly(protocol.HEADER.size))
+
+
+async def recv_payload(reader, length, limit=protocol.MAX_CONTROL_FRAME):
+    """
+    Receive a whole frame payload, like protocol.recv_exact.
+    """
+    protocol.check_length(length, limit)
+    return await reader.readexactly(length)
+
+
+async def recv_json(reader, expected):
+    frame_type, _, length = await recv_header(reader)
+    payload = await recv_payload(reader, length)
+    return protocol.decode_json(frame_type, payload, expected)
+
+
+async def recv_pending_error(reader, timeout=1):
+    """
+    Look for an ERROR frame the peer sent before dropping the connection.
+    Returns a RemoteError, or None if there is none.
+    """
+    try:
+        while True:
+            frame_type, _, length = await asyncio.wait_for(recv_header(reader), timeout)
+            payload = await asyncio.wait_for(recv_payload(reader, length), timeout)
+            if frame_type == protocol.ERROR:
+                data = json.loads(payload.decode())
+                return protocol.RemoteError(data.get("error", "Unknown error."), data)
+    except (
+        OSError,
+        ValueError,
+        asyncio.TimeoutError,
+        asyncio.IncompleteReadError,
+        protocol.ProtocolError,
+    ):
+        return None
+
+
+async def reject(reader, writer, error):
+    """
+    Answer a connection with an ERROR frame and close it. What the peer sends is
+    read and dropped until it closes, closing with unread data would reset the
+    connection and lose the error.
+    """
+    try:
+        await send_json(writer, protocol.ERROR, {"error": error})
+        writer.write_eof()
+        while await asyncio.wait_for(reader.read(DEFAULT_CHUNK), REJECT_TIMEOUT):
+            pass
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def send_file(
+    ip,
+    port,
+    file_path,
+    chunk=DEFAULT_CHUNK,
+    zero_copy=True,
+    inline_hash=False,
+    hash_algo="auto",
+    progress=None,
+):
+    """
+    Send a file or directory. Regular files go through loop.sendfile, which uses the
+    kernel's zero-copy sendfile where it can.
+    `progress` is called with the same progress dicts the blocking engine yields.
+    Returns the receiver's validation result, raises RemoteError if it rejected the
+    transfer.
+    """
+    loop = asyncio.get_running_loop()
+    file_path = os.path.normpath(file_path)
+    is_dir = os.path.isdir(file_path)
+    if is_dir:
+        manifest = await asyncio.to_thread(utils.build_manifest, file_path)
+        parent = os.path.dirname(file_path)
+        files = [
+            (os.path.join(parent, entry["path"]), entry)
+            for entry in manifest
+            if entry["type"] == "file"
+        ]
+        file_size = sum(entry["size"] for entry in manifest)
+    else:
+        file_size = os.path.getsize(file_path)
+        files = [(file_path, {"size": file_size})]
+
+    # prepare metadata, prehashing happens off the event loop
+    metadata = {
+        "name": os.path.basename(file_path),
+        "size": file_size,
+        "mtime": os.path.getmtime(file_path),
+        "hash": None,
+        "hash_algo": hash_algo,
+        "is_dir": is_dir,
+        "archive": "manifest" if is_dir else None,
+        "resume": False,
+        "compress": "none",
+    }
+    if hash_algo == "auto":
+        if inline_hash:
+            metadata["hash_algos"] = utils.available_hash_algos()
+        else:
+            metadata["hash_algo"] = utils.DEFAULT_HASH_ALGO
+    if not inline_hash:
+        for path, entry in files:
+            entry["hash"] = await asyncio.to_thread(
+                utils.get_hash, path, metadata["hash_algo"]
+            )
+        if not is_dir:
+            metadata["hash"] = files[0][1]["hash"]
+    if is_dir:
+        metadata["manifest"] = manifest
+
+    reader, writer = await asyncio.open_connection(ip, port)
+    try:
+        await send_json(writer, protocol.METADATA, metadata)
+
+        # the data is pipelined behind the metadata unless the receiver picks the
+        # hash algorithm
+        algo = metadata["hash_algo"]
+        ack_pending = algo != "auto"
+        if not ack_pending:
+            algo = (await recv_json(reader, protocol.ACK))["hash_algo"]
+
+        sent = 0
+        reporter = ProgressReporter(file_size)
+        for path, entry in files:
+            hasher = utils.new_hasher(algo) if inline_hash else None
+            writer.write(protocol.pack_header(protocol.DATA, entry["size"]))
+            f = await asyncio.to_thread(open, path, "rb")
+            try:
+                if zero_copy and hasher is None:
+                    # sendfile in blocks so progress can be reported
+                    await writer.drain()
+                    offset = 0
+                    while offset < entry["size"]:
+                        count = min(SENDFILE_BLOCK, entry["size"] - offset)
+                        await loop.sendfile(writer.transport, f, offset, count)
+                        offset += count
+                        sent += count
+                        report = reporter.update(sent)
+                        if progress is not None and report is not None:
+                            progress(report)
+                else:
+                    remaining = entry["size"]
+                    while remaining > 0:
+                        data = await asyncio.to_thread(
+                            read_data, f, min(chunk, remaining), hasher
+                        )
+                        if not data:
+                            raise protocol.ProtocolError(
+                                f"{path} changed while it was sent."
+                            )
+                        writer.write(data)
+                        await writer.drain()
+                        remaining -= len(data)
+                        sent += len(data)
+                        report = reporter.update(sent)
+                        if progress is not None and report is not None:
+                            progress(report)
+            finally:
+                await asyncio.to_thread(f.close)
+            file_hash = hasher.hexdigest() if hasher is not None else entry["hash"]
+            trailer = {"hash_algo": algo, "hash": file_hash}
+            await send_json(writer, protocol.TRAILER, trailer)
+
+        if ack_pending:
+            await recv_json(reader, protocol.ACK)
+        return await recv_json(reader, protocol.ACK)
+    except (ConnectionError, asyncio.IncompleteReadError) as e:
+        # the receiver may have rejected the transfer while data was in flight
+        error = await recv_pending_error(reader)
+        if error is None:
+            raise
+        raise error from e
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+
+
+async def receive_file(
+    port, save_dir, chunk=DEFAULT_CHUNK, hash_algo="auto", progress=None
+):
+    """
+    Receive a single transfer on the given port. Senders connecting once the first
+    one is accepted are turned away with an ERROR frame.
+    Returns an error message if validation failed, otherwise None.
+    """
+    done = asyncio.get_running_loop().create_future()
+    accepted = False
+
+    async def handle(reader, writer):
+        nonlocal accepted
+        if accepted:
+            await reject(reader, writer, "The receiver is busy with another transfer.")
+            return
+        accepted = True
+        try:
+            result = await receive_transfer(
+                reader, writer, save_dir, chunk, hash_algo, progress
+            )
+            if not done.done():  # unless receive_file was cancelled
+                done.set_result(result)
+        except Exception as e:
+            if not done.done():
+                done.set_exception(e)
+
+    server = await asyncio.start_server(handle, "0.0.0.0", port)
+    async with server:
+        return await done
+
+
+async def serve_files(
+    port, save_dir, chunk=DEFAULT_CHUNK, hash_algo="auto", progress=None
+):
+    """
+    Receive transfers from any number of senders at once until cancelled.
+    `progress` is called with progress dicts carrying the transfer's name.
+    """
+
+    async def handle(reader, writer):
+        try:
+            await receive_transfer(reader, writer, save_dir, chunk, hash_algo, progress)
+        except Exception as e:
+            print(f"File transfer failed: {e}")
+
+    server = await asyncio.start_server(handle, "0.0.0.0", port)
+    async with server:
+        await server.serve_forever()
+
+
+async def receive_transfer(reader, writer, save_dir, chunk, hash_algo, progress):
+    """
+    Receive one transfer over an accepted connection.
+    Returns an error message if validation failed, otherwise None.
+    """
+    try:
+        metadata = await recv_json(reader, protocol.METADATA)
+        if "stream" in metadata:
+            error = "Multi-stream transfers are not supported by this receiver."
+            await send_json(writer, protocol.ERROR, {"error": error})
+            return error
+        file_size = metadata["size"]
+        archive = metadata.get("archive", "zip" if metadata["is_dir"] else None)
+        supported_algos = get_supported_hash_algos(hash_algo)
+
+        # negotiate, rejecting what only the blocking engine handles
+        algo = resolve_hash_algo(metadata, supported_algos)
+        codec = resolve_codec(metadata)
+        error = None
+        if "ranges" in metadata or archive == "tar":
+            error = "Multi-stream and tar transfers are not supported by this receiver."
+        elif algo is None:
+            error = f"Hash algorithm {metadata['hash_algo']} is not supported."
+        elif codec is None:
+            error = f"Compression codec {metadata['compress']} is not supported."
+        if error is not None:
+            await send_json(writer, protocol.ERROR, {"error": error})
+            return error
+        ack = {
+            "hash_algo": algo,
+            "hash_algos": supported_algos,
+            "offset": 0,
+            "compress": codec,
+        }
+        await send_json(writer, protocol.ACK, ack)
+
+        if archive == "manifest":
+            entries = metadata["manifest"]
+        else:
+            entries = [{"path": metadata["name"], "type": "file", "size": file_size}]
+
+        os.makedirs(save_dir, exist_ok=True)
+        decompress = compression.new_decompressor(codec)
+        received = 0
+        reporter = ProgressReporter(file_size)
+        errors = []
+        for entry in entries:
+            try:
+                path = utils.safe_join(save_dir, entry["path"])
+            except ValueError as e:
+                raise protocol.ProtocolError(str(e))
+            if entry["type"] == "dir":
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            hasher = utils.new_hasher(algo)
+            written = 0
+            f = await asyncio.to_thread(open, path, "wb")
+            try:
+                # data frames until the trailer
+                frame_type, flags, size = await recv_header(reader)
+                while frame_type == protocol.DATA:
+                    async for data in iter_data(reader, flags, size, chunk, decompress):
+                        await asyncio.to_thread(write_data, f, data, hasher)
+                        written += len(data)
+                        received += len(data)
+                        report = reporter.update(received)
+                        if progress is not None and report is not None:
+                            progress({"name": metadata["name"], **report})
+                    frame_type, flags, size = await recv_header(reader)
+                payload = await recv_payload(reader, size)
+                trailer = protocol.decode_json(frame_type, payload, protocol.TRAILER)
+            finally:
+                await asyncio.to_thread(f.close)
+            if "mtime" in entry:
+                await asyncio.to_thread(set_attributes, path, entry)
+            if written != entry["size"]:
+                error = f"Received {written} bytes but expected {entry['size']}."
+            else:
+                error = check_hash(hasher, trailer.get("hash") or metadata["hash"])
+            if error is not None:
+                errors.append(f"{entry['path']}: {error}")
+
+        if errors:
+            error = " ".join(errors)
+            message = f"File validation failed! {error}"
+            await send_json(writer, protocol.ERROR, {"error": message})
+            return error
+        await send_json(writer, protocol.ACK, {"validated": algo != "none"})
+
+        # Unpack zip file if it is a directory
+        if archive == "zip":
+            zip_path = utils.safe_join(save_dir, metadata["name"])
+            await asyncio.to_thread(utils.unzip_dir, zip_path, save_dir)
+            await asyncio.to_thread(os.remove, zip_path)
+        return None
+    except protocol.ProtocolError as e:
+        # tell the sender why, it may still be sending
+        try:
+            await send_json(
+                writer, protocol.ERROR, {"error": f"File transfer failed: {e}"}
+            )
+        except OSError:
+            pass
+        raise
+    finally:
+        writer.close()
+
+
+async def iter_data(reader, flags, length, chunk, decompress=None):
+    """
+    Receive the payload of a DATA frame as raw data, like protocol.iter_data.
+    """
+    if flags & protocol.COMPRESSED:
+        if decompress is None:
+            raise protocol.ProtocolError("Received a compressed frame without a codec.")
+        payload = await recv_payload(reader, length, protocol.MAX_COMPRESSED_FRAME)
+        try:
+            data = await asyncio.to_thread(decompress, payload)
+        except ValueError as e:
+            raise protocol.ProtocolError(str(e))
+        yield data
+        return
+    remaining = length
+    while remaining > 0:
+        data = await reader.read(min(chunk, remaining))
+        if not data:
+            raise ConnectionError("Connection closed by peer.")
+        remaining -= len(data)
+        yield data
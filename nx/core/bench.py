@@ -0,0 +1,225 @@
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+from . import utilities as utils
+
+DATASETS = ["random", "text", "many"]
+DEFAULT_SIZES = ["1K", "1M", "100M"]
+DEFAULT_CHUNKS = ["64", "1024", "auto"]  # kb or auto
+DEFAULT_HASHES = ["none", "auto"]
+SMALL_FILE = 1024 * 16  # bytes per file of the "many" dataset
+WRITE_BLOCK = 1024 * 1024  # bytes generated per write
+LISTEN_TIMEOUT = 10  # seconds to wait for the receiver to start listening
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+WORDS = (
+    "the quick brown fox jumps over the lazy dog while network data exchanger"
+    " sends files between computers on the same local network"
+).split()
+
+
+def parse_size(value):
+    """
+    Convert a size such as 512, 64K, 100M or 10G to bytes.
+    """
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def write_data(path, size, kind):
+    """
+    Write `size` bytes of incompressible random data, or compressible text.
+    """
+    if kind == "text":
+        # the same text on every run
+        words = random.Random(0).choices(WORDS, k=WRITE_BLOCK // 4)
+        text = " ".join(words).encode()[:WRITE_BLOCK]
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            n = min(WRITE_BLOCK, remaining)
+            f.write(text[:n] if kind == "text" else os.urandom(n))
+            remaining -= n
+
+
+def make_dataset(root, kind, size):
+    """
+    Create a dataset under `root` unless it exists from an earlier run.
+    "random" and "text" are single files, "many" is a directory of SMALL_FILE sized
+    files spread over subdirectories.
+    Returns the path of the dataset and its number of files.
+    """
+    path = os.path.join(root, f"{kind}-{size}")
+    count = max(1, -(-size // SMALL_FILE)) if kind == "many" else 1
+    if os.path.exists(path):
+        return path, count
+    if kind != "many":
+        write_data(path + ".tmp", size, kind)
+        os.replace(path + ".tmp", path)
+        return path, count
+    os.makedirs(path + ".tmp")
+    for index in range(count):
+        directory = os.path.join(path + ".tmp", f"d{index // 256}")
+        os.makedirs(directory, exist_ok=True)
+        file_size = min(SMALL_FILE, size - index * SMALL_FILE)
+        write_data(os.path.join(directory, f"f{index}.bin"), file_size, "random")
+    os.replace(path + ".tmp", path)
+    return path, count
+
+
+def wait_process(process):
+    """
+    Wait for a process to exit.
+    Returns a tuple of (CPU seconds, peak RSS in mb), both None where the platform
+    can't tell.
+    """
+    if not hasattr(os, "wait4"):
+        process.wait()
+        return None, None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # ru_maxrss is in kb on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return usage.ru_utime + usage.ru_stime, usage.ru_maxrss / scale
+
+
+def run_nx(*args, **kwargs):
+    """
+    Start nx in a new process with the same interpreter and package as this one.
+    """
+    return subprocess.Popen(
+        [sys.executable, "-m", "nx.cli.cli_main", *args],
+        cwd=os.path.dirname(utils.get_project_root()),
+        **kwargs,
+    )
+
+
+def run_case(root, path, chunk, hash_algo, zip_mode):
+    """
+    Send a dataset over loopback with the sender and receiver each in a process of
+    its own, so their CPU time and peak memory are measured apart.
+    Returns a dict of the wall seconds, and CPU seconds and peak RSS of both sides.
+    """
+    port = free_port()
+    save_dir = os.path.join(root, "received")
+    shutil.rmtree(save_dir, ignore_errors=True)
+    log_path = os.path.join(root, "receiver.log")
+    options = ["--chunk", chunk, "--hash", hash_algo]
+    with open(log_path, "w+") as log:
+        receiver = run_nx(
+            "get", "file", str(port), save_dir, *options, stdout=log, stderr=log
+        )
+        try:
+            # the receiver prints this line once its socket is listening
+            deadline = time.monotonic() + LISTEN_TIMEOUT
+            log.seek(0)
+            while "Listening" not in log.read():
+                if receiver.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The receiver didn't start listening.")
+                time.sleep(0.05)
+                log.seek(0)
+
+            start = time.perf_counter()
+            sender = run_nx(
+                "post",
+                "file",
+                "127.0.0.1",
+                str(port),
+                path,
+                *options,
+                *(["--zip"] if zip_mode else []),
+                stdout=subprocess.DEVNULL,
+            )
+            sender_cpu, sender_rss = wait_process(sender)
+            if sender.returncode:
+                receiver.kill()
+            receiver_cpu, receiver_rss = wait_process(receiver)
+            seconds = time.perf_counter() - start
+        finally:
+            if receiver.poll() is None:
+                receiver.kill()
+                receiver.wait()
+        log.seek(0)
+        output = log.read()
+    if sender.returncode or receiver.returncode or "failed" in output.lower():
+        raise RuntimeError(f"Transfer of {path} failed: {output}")
+    shutil.rmtree(save_dir, ignore_errors=True)
+    return {
+        "seconds": seconds,
+        "cpu_seconds": {"sender": sender_cpu, "receiver": receiver_cpu},
+        "peak_rss_mb": {"sender": sender_rss, "receiver": receiver_rss},
+    }
+
+
+def run_suite(
+    root,
+    datasets=DATASETS,
+    sizes=DEFAULT_SIZES,
+    chunks=DEFAULT_CHUNKS,
+    hashes=DEFAULT_HASHES,
+    zip_modes=(False,),
+    runs=1,
+):
+    """
+    Run every combination of dataset, size, chunk size, hash algorithm and zip mode,
+    generating the datasets under `root`. Zip mode only applies to directories.
+    Of several runs of a case the fastest is kept, it is the least disturbed by
+    other processes.
+    Yields one result dict per case.
+    """
+    root = os.path.abspath(root)
+    os.makedirs(root, exist_ok=True)
+    for kind in datasets:
+        for size in map(parse_size, sizes):
+            path, count = make_dataset(root, kind, size)
+            for chunk in chunks:
+                for hash_algo in hashes:
+                    for zip_mode in zip_modes:
+                        if zip_mode and kind != "many":
+                            continue
+                        result = min(
+                            (
+                                run_case(root, path, chunk, hash_algo, zip_mode)
+                                for _ in range(runs)
+                            ),
+                            key=lambda result: result["seconds"],
+                        )
+                        yield {
+                            "dataset": kind,
+                            "size": size,
+                            "files": count,
+                            "chunk": chunk,
+                            "hash": hash_algo,
+                            "zip": zip_mode,
+                            "mb_s": size / (1024 * 1024) / result["seconds"],
+                            **result,
+                        }
+
+
+def system_info():
+    """
+    Describe the machine and version of a benchmark run, so results of different
+    releases can be compared.
+    """
+    return {
+        "version": utils.read_manifest()["version"],
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
@@ -0,0 +1,257 @@
+import collections
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+CODECS = ["zstd", "lz4", "deflate"]  # ordered by preference for auto
+COMPRESS_CHOICES = ["none", *CODECS, "auto"]
+COMPRESS_BLOCK = 1024 * 1024  # bytes of raw data compressed per DATA frame
+ZSTD_LEVEL = 3
+DEFLATE_LEVEL = 1  # the default level costs a lot of CPU for little gain
+MIN_RATIO = 0.9  # compressed/raw ratio above which a block counts as incompressible
+PROBE_INTERVAL = 32  # blocks sent raw before probing incompressible data again
+QUEUE_DEPTH = 2  # blocks in flight per compression worker
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# zstd contexts can't be shared between threads, so every thread keeps its own
+_local = threading.local()
+
+# already compressed formats that auto mode sends as is
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".7z",
+    ".aac",
+    ".avi",
+    ".br",
+    ".bz2",
+    ".docx",
+    ".flac",
+    ".gif",
+    ".gz",
+    ".heic",
+    ".jar",
+    ".jpeg",
+    ".jpg",
+    ".lz4",
+    ".m4a",
+    ".mkv",
+    ".mov",
+    ".mp3",
+    ".mp4",
+    ".ogg",
+    ".opus",
+    ".png",
+    ".pptx",
+    ".rar",
+    ".tgz",
+    ".webm",
+    ".webp",
+    ".whl",
+    ".xlsx",
+    ".xz",
+    ".zip",
+    ".zst",
+}
+
+
+def available_codecs():
+    """
+    Compression codecs usable on this machine, ordered by preference.
+    """
+    codecs = []
+    if zstandard is not None:
+        codecs.append("zstd")
+    if lz4_frame is not None:
+        codecs.append("lz4")
+    codecs.append("deflate")
+    return codecs
+
+
+def negotiate_codec(offered, supported):
+    """
+    Pick the first codec offered by the sender that is also supported here.
+    """
+    for codec in offered:
+        if codec in supported:
+            return codec
+    return "none"
+
+
+def is_incompressible(name):
+    return os.path.splitext(name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS
+
+
+def new_decompressor(codec, max_size=COMPRESS_BLOCK):
+    """
+    Returns a function that decompresses one DATA frame, or None for "none".
+    Corrupt data, and frames that decompress to more than `max_size` bytes, raise
+    ValueError, whichever error the codec itself raises.
+    """
+    if codec == "none":
+        return None
+    if codec == "zstd":
+        _decompress = zstd_decompressor(max_size)
+    elif codec == "lz4":
+        _decompress = lz4_decompressor(max_size)
+    elif codec == "deflate":
+        _decompress = deflate_decompressor(max_size)
+    else:
+        raise ValueError(f"Unsupported compression codec {codec}")
+
+    def decompress(data):
+        try:
+            return _decompress(data)
+        except ValueError:
+            raise
+        except Exception as e:  # zlib.error, ZstdError, RuntimeError from lz4
+            raise ValueError(f"Invalid {codec} data: {e}")
+
+    return decompress
+
+
+def check_output(eof, needs_input, max_size):
+    """
+    Raise ValueError unless a bounded decompressor reached the end of its frame.
+    """
+    if needs_input:
+        raise ValueError("Incomplete compressed frame.")
+    if not eof:
+        raise ValueError(f"Frame decompresses to more than {max_size} bytes.")
+
+
+def zstd_decompressor(max_size):
+    context = zstandard.ZstdDecompressor()
+
+    def decompress(data):
+        # max_output_size only applies to frames that don't record their size
+        if zstandard.frame_content_size(data) > max_size:
+            raise ValueError(f"Frame decompresses to more than {max_size} bytes.")
+        return context.decompress(data, max_output_size=max_size)
+
+    return decompress
+
+
+def lz4_decompressor(max_size):
+    def decompress(data):
+        decompressor = lz4_frame.LZ4FrameDecompressor()
+        output = decompressor.decompress(data, max_length=max_size)
+        eof = decompressor.eof
+        check_output(eof, decompressor.needs_input and not eof, max_size)
+        return output
+
+    return decompress
+
+
+def deflate_decompressor(max_size):
+    def decompress(data):
+        decompressor = zlib.decompressobj()
+        output = decompressor.decompress(data, max_size)
+        eof = decompressor.eof
+        check_output(eof, not eof and not decompressor.unconsumed_tail, max_size)
+        return output
+
+    return decompress
+
+
+def zstd_compress(data):
+    if not hasattr(_local, "zstd"):
+        _local.zstd = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return _local.zstd.compress(data)
+
+
+class Compressor:
+    """
+    Compresses DATA frames one block at a time, so every frame can be decompressed on
+    its own. A block that doesn't shrink is sent raw. Blocks may be compressed from
+    several threads at once.
+    In adaptive mode known compressed formats are never compressed, and after a block
+    compresses poorly the next PROBE_INTERVAL blocks are sent raw before trying again.
+    """
+
+    def __init__(self, codec, adaptive=False, name=None):
+        if codec == "zstd":
+            self._compress = zstd_compress
+        elif codec == "lz4":
+            self._compress = lz4_frame.compress
+        elif codec == "deflate":
+            self._compress = lambda data: zlib.compress(data, DEFLATE_LEVEL)
+        else:
+            raise ValueError(f"Unsupported compression codec {codec}")
+        self.adaptive = adaptive
+        self.enabled = not (adaptive and name is not None and is_incompressible(name))
+        self.skip = 0
+
+    def compress(self, data):
+        """
+        Returns a tuple of (payload, compressed).
+        """
+        if not self.enabled or not data:
+            return data, False
+        if self.skip:
+            self.skip -= 1
+            return data, False
+        packed = self._compress(data)
+        if self.adaptive and len(packed) > len(data) * MIN_RATIO:
+            self.skip = PROBE_INTERVAL
+        if len(packed) >= len(data):
+            return data, False
+        return packed, True
+
+
+def new_compressor(codec, adaptive=False, name=None):
+    """
+    Returns a Compressor for the codec, or None for "none".
+    """
+    if codec == "none":
+        return None
+    return Compressor(codec, adaptive, name)
+
+
+def compress_blocks(blocks, jobs=1):
+    """
+    Compress blocks on a pool of `jobs` threads while keeping their order. zlib, lz4
+    and zstd release the GIL, so the blocks are compressed on several cores.
+    At most QUEUE_DEPTH blocks per worker are in flight, which bounds the memory used
+    and lets the pool run ahead of the socket.
+    `blocks` yields tuples of (data, compressor, tag). Blocks without a compressor
+    are passed through as is.
+    Yields tuples of (data, payload, compressed, tag).
+    """
+    if jobs <= 1:
+        for data, compressor, tag in blocks:
+            if compressor is None:
+                yield data, data, False, tag
+            else:
+                yield (data, *compressor.compress(data), tag)
+        return
+
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for data, compressor, tag in blocks:
+            if compressor is None:
+                result = None
+            else:
+                result = pool.submit(compressor.compress, data)
+            pending.append((data, result, tag))
+            while len(pending) > jobs * QUEUE_DEPTH or (
+                pending and pending[0][1] is None
+            ):
+                yield finish_block(*pending.popleft())
+        while pending:
+            yield finish_block(*pending.popleft())
+
+
+def finish_block(data, result, tag):
+    if result is None:
+        return data, data, False, tag
+    return (data, *result.result(), tag)
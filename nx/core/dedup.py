@@ -0,0 +1,215 @@
+import collections
+import hashlib
+import mmap
+import os
+import random
+import threading
+import uuid
+
+from . import utilities as utils
+
+MIN_CHUNK = 1024 * 16
+MAX_CHUNK = 1024 * 256
+SEGMENT = 1024 * 1024 * 8  # bytes scanned for chunk boundaries at a time
+DEFAULT_STORE_SIZE = 1024 * 1024 * 1024  # bytes kept in the chunk store
+
+# Content-defined chunking in the spirit of FastCDC. A gear hash rolled one byte at
+# a time would be far too slow in Python, so every byte is instead mixed with the 15
+# before it through random tables, xor-ing whole segments as big integers so all of
+# it runs in C. A position may end a chunk when its mixed byte and the one
+# ANCHOR_GAP bytes before are both below ANCHOR_LIMIT, which is about one in 16 KiB
+# for random data as well as text and only depends on the bytes right around it.
+WINDOW_SPREADS = (4, 8)  # after mixing 4 bytes, double the window twice
+_tables = [bytes(random.Random(seed).sample(range(256), 256)) for seed in range(6)]
+ANCHOR_LIMIT = 2
+ANCHOR_GAP = 3
+_anchor_table = bytes(0 if value < ANCHOR_LIMIT else 1 for value in range(256))
+
+
+def find_anchors(data):
+    """
+    Returns bytes that are zero at every position of data that may end a chunk.
+    """
+    mixed = 0
+    for shift, table in enumerate(_tables[:4]):
+        mixed ^= int.from_bytes(data.translate(table), "little") << (8 * shift)
+    size = len(data) + 4
+    for spread, table in zip(WINDOW_SPREADS, _tables[4:]):
+        shuffled = mixed.to_bytes(size, "little").translate(table)
+        mixed ^= int.from_bytes(shuffled, "little") << (8 * spread)
+        size += spread
+    marks = mixed.to_bytes(size, "little").translate(_anchor_table)
+    marks = int.from_bytes(marks, "little")
+    marks |= marks << (8 * ANCHOR_GAP)
+    return marks.to_bytes(size + ANCHOR_GAP, "little")
+
+
+def iter_chunks(data):
+    """
+    Split data, e.g. a memory mapped file, into content-defined chunks, so an insert
+    or delete only changes the chunks around it.
+    Yields tuples of (start, end).
+    """
+    size = len(data)
+    start = 0
+    while start < size:
+        window = min(SEGMENT, size - start)
+        marks = find_anchors(data[start : start + window])
+        offset = 0
+        while offset < window:
+            if window - offset < MAX_CHUNK and start + window < size:
+                break  # the next chunk may reach past this segment
+            limit = min(offset + MAX_CHUNK, window)
+            anchor = marks.find(0, offset + MIN_CHUNK, limit)
+            end = limit if anchor < 0 else anchor + 1
+            yield start + offset, start + end
+            offset = end
+        start += offset
+
+
+def chunk_hash(data):
+    return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+def chunk_file(path, hasher=None):
+    """
+    List the chunks of a file as [hash, size] pairs.
+    If a hasher is given, the whole file is fed into it on the way.
+    """
+    chunks = []
+    if os.path.getsize(path) == 0:
+        return chunks
+    with open(path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        for start, end in iter_chunks(data):
+            block = data[start:end]
+            if hasher is not None:
+                hasher.update(block)
+            chunks.append([chunk_hash(block), end - start])
+    return chunks
+
+
+class ChunkStore:
+    """
+    Content-addressed chunk store under the app data root, capped at `max_size`
+    bytes. Looking up a chunk marks it as used, and the least recently used chunks
+    are evicted first, as soon as a new chunk takes the store over its cap.
+    Chunks pinned by a running transfer are never evicted. The store may be shared
+    by the threads of a server.
+    Use is tracked in memory, loaded from the modification time of the files,
+    which lookups keep up to date for the next run.
+    """
+
+    def __init__(self, root=None, max_size=DEFAULT_STORE_SIZE):
+        self.root = root or os.path.join(utils.get_appdata_root(), "chunks")
+        self.max_size = max_size
+        self.chunks = None  # digest -> size, least recently used first
+        self.pinned = {}  # digest -> [transfers pinning it, size or None if absent]
+        self.size = 0  # bytes of all stored chunks, pinned ones included
+        self.lock = threading.Lock()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def load(self):
+        """
+        List the chunks on disk on first use. Must be called with the lock held.
+        """
+        if self.chunks is not None:
+            return
+        entries = []
+        if os.path.isdir(self.root):
+            for folder in os.scandir(self.root):
+                if folder.is_dir():
+                    for entry in os.scandir(folder.path):
+                        if not entry.name.endswith(".tmp"):
+                            st = entry.stat()
+                            entries.append((st.st_mtime, st.st_size, entry.name))
+        self.chunks = collections.OrderedDict(
+            (digest, size) for _, size, digest in sorted(entries)
+        )
+        self.size = sum(self.chunks.values())
+
+    def add(self, digest, size):
+        """
+        Record a stored chunk as the most recently used. Must be called with the
+        lock held.
+        """
+        if digest in self.pinned:
+            if self.pinned[digest][1] is None:
+                self.pinned[digest][1] = size
+                self.size += size
+        elif digest in self.chunks:
+            self.chunks.move_to_end(digest)
+        else:
+            self.chunks[digest] = size
+            self.size += size
+
+    def has(self, digest):
+        path = self.path(digest)
+        try:
+            os.utime(path)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            self.load()
+            self.add(digest, size)
+        return True
+
+    def get(self, digest):
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def put(self, digest, data):
+        path = self.path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.load()
+            self.add(digest, len(data))
+            self.evict_locked()
+
+    def pin(self, digests):
+        """
+        Keep chunks from being evicted until they are unpinned, including chunks that
+        aren't stored yet. Chunks may be pinned by several transfers at once.
+        """
+        with self.lock:
+            self.load()
+            for digest in digests:
+                if digest in self.pinned:
+                    self.pinned[digest][0] += 1
+                else:
+                    self.pinned[digest] = [1, self.chunks.pop(digest, None)]
+
+    def unpin(self, digests):
+        """
+        Release chunks pinned with `pin`, then evict what no longer fits.
+        """
+        with self.lock:
+            for digest in digests:
+                entry = self.pinned[digest]
+                entry[0] -= 1
+                if entry[0] == 0:
+                    del self.pinned[digest]
+                    if entry[1] is not None:
+                        self.chunks[digest] = entry[1]
+            self.evict_locked()
+
+    def evict_locked(self):
+        """
+        Remove the least recently used chunks until the store fits its size cap.
+        Must be called with the lock held.
+        """
+        while self.size > self.max_size and self.chunks:
+            digest, size = self.chunks.popitem(last=False)
+            try:
+                os.remove(self.path(digest))
+            except FileNotFoundError:
+                pass
+            self.size -= size
@@ -0,0 +1,118 @@
+import hashlib
+import math
+import zlib
+
+MIN_BLOCK = 1024 * 2
+MAX_BLOCK = 1024 * 128
+MAX_RUN_BYTES = 1024 * 1024  # bytes covered by one literal piece or block reference
+ROLL_MISSES = 8  # missed blocks in a row after which the rolling search pauses
+ROLL_PROBE = 64  # blocks compared at fixed offsets before rolling again
+ADLER_MOD = 65521
+
+
+def block_size(file_size):
+    """
+    Signature block size, about the square root of the file size like rsync uses.
+    """
+    size = int(math.sqrt(file_size)) // 1024 * 1024
+    return min(max(size, MIN_BLOCK), MAX_BLOCK)
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def build_signatures(path, block):
+    """
+    Weak rolling (adler32) and strong checksums of every full block of a file.
+    Returns a list of [weak, strong] pairs, ordered by block index.
+    """
+    signatures = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(block)
+            if len(data) < block:
+                break
+            signatures.append([zlib.adler32(data), strong_hash(data)])
+    return signatures
+
+
+def iter_delta(data, signatures, block):
+    """
+    Compare data, e.g. a memory mapped file, against the block signatures of the
+    receiver's copy.
+    Yields ("ref", first block index, block count) for runs of blocks the receiver
+    already has and ("literal", start, end) for byte ranges it has to be sent.
+
+    After a miss the weak checksum is rolled one byte at a time through the next
+    block, which finds data that was shifted by an insert or delete. Rolling is done
+    in Python, so it pauses after ROLL_MISSES misses in a row and the search falls
+    back to comparing whole blocks, rolling again every ROLL_PROBE blocks.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(signatures):
+        table.setdefault(weak, []).append((strong, index))
+    max_run = max(1, MAX_RUN_BYTES // block)
+
+    def match(position, weak):
+        candidates = table.get(weak)
+        if candidates:
+            strong = strong_hash(data[position : position + block])
+            for candidate, index in candidates:
+                if candidate == strong:
+                    return index
+        return None
+
+    size = len(data)
+    position = 0
+    literal = 0  # start of the data not matched yet
+    run = None  # pending run of consecutive blocks as [first index, count]
+    misses = 0
+    while position + block <= size:
+        start = position
+        weak = zlib.adler32(data[position : position + block])
+        index = match(position, weak)
+        if index is None and (misses < ROLL_MISSES or misses % ROLL_PROBE == 0):
+            a = weak & 0xFFFF
+            b = weak >> 16
+            end = min(position + block, size - block)
+            while position < end:
+                removed = data[position]
+                a = (a - removed + data[position + block]) % ADLER_MOD
+                b = (b - block * removed - 1 + a) % ADLER_MOD
+                position += 1
+                weak = b << 16 | a
+                if weak in table:
+                    index = match(position, weak)
+                    if index is not None:
+                        break
+        if index is None:
+            misses += 1
+            if position == start:
+                position += block
+            continue
+
+        # matched a block at position
+        misses = 0
+        if literal < position:
+            if run is not None:
+                yield "ref", run[0], run[1]
+                run = None
+            yield from iter_literal(literal, position)
+        if run is not None and run[0] + run[1] == index and run[1] < max_run:
+            run[1] += 1
+        else:
+            if run is not None:
+                yield "ref", run[0], run[1]
+            run = [index, 1]
+        position += block
+        literal = position
+
+    if run is not None:
+        yield "ref", run[0], run[1]
+    yield from iter_literal(literal, size)
+
+
+def iter_literal(start, end):
+    for offset in range(start, end, MAX_RUN_BYTES):
+        yield "literal", offset, min(offset + MAX_RUN_BYTES, end)
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+
+from . import utilities as utils
+
+INDEX_FILE = "file_index.db"
+MTIME_TOLERANCE = 2  # seconds, FAT stores modification times in 2 second steps
+
+
+class FileIndex:
+    """
+    Persistent index of file hashes in an SQLite database under the app data root,
+    keyed by absolute path and hash algorithm. A stored hash is reused for as long
+    as the size and modification time of the file are unchanged, so unchanged files
+    are never hashed again.
+    A connection is bound to the thread that opened it.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(utils.get_appdata_root(), INDEX_FILE)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT, algo TEXT, size INTEGER,"
+            " mtime_ns INTEGER, hash TEXT, PRIMARY KEY (path, algo))"
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get_hash(self, path, algo):
+        """
+        Returns the hash of a file, from the index if the file is unchanged since it
+        was last hashed.
+        """
+        path = os.path.abspath(path)
+        # stat before hashing, a file modified meanwhile is hashed again next time
+        st = os.stat(path)
+        row = self.db.execute(
+            "SELECT hash FROM files WHERE path = ? AND algo = ? AND size = ?"
+            " AND mtime_ns = ?",
+            (path, algo, st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        file_hash = utils.get_hash(path, algo)
+        self.update(path, algo, file_hash, st)
+        return file_hash
+
+    def update(self, path, algo, file_hash, st=None):
+        """
+        Record the hash of a file, e.g. one that was just received and validated.
+        """
+        path = os.path.abspath(path)
+        st = st or os.stat(path)
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            (path, algo, st.st_size, st.st_mtime_ns, file_hash),
+        )
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def find_unchanged(root, manifest, algo):
+    """
+    Indices of the files of a manifest whose copy under `root` has the same size,
+    modification time and hash. Without a hash algorithm size and modification time
+    decide on their own.
+    """
+    unchanged = []
+    with FileIndex() as index:
+        for position, entry in enumerate(manifest):
+            if entry["type"] != "file":
+                continue
+            path = utils.safe_join(root, entry["path"])
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size != entry["size"]:
+                continue
+            if abs(st.st_mtime - entry["mtime"]) > MTIME_TOLERANCE:
+                continue
+            if algo == "none" or index.get_hash(path, algo) == entry["hash"]:
+                unchanged.append(position)
+    return unchanged
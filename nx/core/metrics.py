@@ -0,0 +1,177 @@
+import threading
+import time
+
+# Phases in the order a transfer goes through them. Each side only records the
+# phases it actually has, e.g. zip on the sender and unzip on the receiver. The
+# hash phase includes building the manifest, and the metadata phase lasts until
+# the data starts, including the round trip of the acknowledgment.
+PHASES = ["connect", "zip", "hash", "metadata", "data", "validate", "unzip"]
+
+
+class TransferMetrics:
+    """
+    Timings and counters of one transfer: seconds per phase, bytes moved, and the
+    number of socket and disk calls with the seconds spent blocked in them, on
+    whichever thread made them.
+    Phases follow each other, entering one ends the one before.
+    Hooks are called with an event name and a dict of its fields as the transfer
+    goes: "phase_start", "phase_end" and, from `finish`, "transfer_end" with the
+    whole summary. Streams of a transfer record from several threads at once.
+    """
+
+    def __init__(self, side, hooks=()):
+        self.side = side
+        self.hooks = list(hooks)
+        self.phases = {}
+        self.current = None  # running phase and when it started
+        self.bytes = {"sent": 0, "received": 0, "read": 0, "written": 0}
+        self.calls = {"socket": 0, "disk": 0}
+        self.stall = {"socket": 0.0, "disk": 0.0}
+        self.start = None  # the first phase starts the clock
+        self.seconds = None
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def emit(self, event, **fields):
+        for hook in self.hooks:
+            hook(event, fields)
+
+    def enter(self, name):
+        """
+        End the running phase and start the next one, or only end it without a
+        name. A phase entered more than once adds up.
+        """
+        now = time.perf_counter()
+        if self.start is None:
+            self.start = now
+        if self.current is not None:
+            running, start = self.current
+            self.phases[running] = self.phases.get(running, 0) + now - start
+            self.emit("phase_end", name=running, seconds=now - start)
+        self.current = None
+        if name is not None:
+            self.current = (name, now)
+            self.emit("phase_start", name=name)
+
+    def record(self, kind, seconds, direction=None, size=0):
+        """
+        Count a socket or disk call that took `seconds` and moved `size` bytes in
+        `direction`, one of the keys of `bytes`.
+        """
+        with self.lock:
+            self.calls[kind] += 1
+            self.stall[kind] += seconds
+            if direction is not None:
+                self.bytes[direction] += size
+
+    def socket(self, sock):
+        return MeteredSocket(sock, self)
+
+    def file(self, f):
+        return MeteredFile(f, self)
+
+    def writer(self, write):
+        """
+        Wrap a `write(data, position)` function of the receive path.
+        """
+
+        def metered_write(data, position):
+            start = time.perf_counter()
+            write(data, position)
+            self.record("disk", time.perf_counter() - start, "written", len(data))
+
+        return metered_write
+
+    def finish(self):
+        self.enter(None)
+        self.seconds = time.perf_counter() - self.start
+        summary = self.as_dict()
+        self.emit("transfer_end", **summary)
+        return summary
+
+    def as_dict(self):
+        phases = {name: self.phases[name] for name in PHASES if name in self.phases}
+        return {
+            "side": self.side,
+            "seconds": self.seconds,
+            "phases": phases,
+            "bytes": dict(self.bytes),
+            "calls": dict(self.calls),
+            "stall_seconds": dict(self.stall),
+        }
+
+
+class MeteredSocket:
+    """
+    Socket wrapper recording every send and receive call in a TransferMetrics.
+    Everything else is passed through to the socket.
+    """
+
+    def __init__(self, sock, metrics):
+        self.sock = sock
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def sendall(self, data, *args):
+        start = time.perf_counter()
+        self.sock.sendall(data, *args)
+        self.metrics.record("socket", time.perf_counter() - start, "sent", len(data))
+
+    def sendfile(self, file, offset=0, count=None):
+        start = time.perf_counter()
+        n = self.sock.sendfile(file, offset, count)
+        self.metrics.record("socket", time.perf_counter() - start, "sent", n)
+        return n
+
+    def recv(self, size, *args):
+        start = time.perf_counter()
+        data = self.sock.recv(size, *args)
+        seconds = time.perf_counter() - start
+        self.metrics.record("socket", seconds, "received", len(data))
+        return data
+
+    def recv_into(self, buffer, *args):
+        start = time.perf_counter()
+        n = self.sock.recv_into(buffer, *args)
+        self.metrics.record("socket", time.perf_counter() - start, "received", n)
+        return n
+
+
+class MeteredFile:
+    """
+    File wrapper recording every read and write call in a TransferMetrics.
+    Everything else is passed through to the file.
+    """
+
+    def __init__(self, f, metrics):
+        self.f = f
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.f.close()
+
+    def timed(self, direction, call, *args):
+        start = time.perf_counter()
+        result = call(*args)
+        size = result if isinstance(result, int) else len(result)
+        self.metrics.record("disk", time.perf_counter() - start, direction, size)
+        return result
+
+    def read(self, *args):
+        return self.timed("read", self.f.read, *args)
+
+    def readinto(self, buffer):
+        return self.timed("read", self.f.readinto, buffer)
+
+    def write(self, data):
+        return self.timed("written", self.f.write, data)
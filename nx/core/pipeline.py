@@ -0,0 +1,110 @@
+import queue
+import threading
+
+DEFAULT_DEPTH = 4  # chunks read ahead of the socket or written behind it
+
+
+def read_ahead(f, offset, length, chunk, depth=DEFAULT_DEPTH):
+    """
+    Read a byte range of an opened file on a separate thread, up to `depth` chunks
+    ahead of the consumer, so a slow disk and the socket work at the same time.
+    The file must not be used by anyone else until the generator is done.
+    Yields memoryviews of at most `chunk` bytes, each valid until the next one is
+    requested.
+    """
+    free = queue.Queue()
+    for _ in range(depth + 1):
+        free.put(bytearray(chunk))
+    filled = queue.Queue()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            f.seek(offset)
+            remaining = length
+            while remaining > 0 and not stop.is_set():
+                buffer = free.get()
+                n = f.readinto(memoryview(buffer)[: min(chunk, remaining)])
+                if not n:
+                    break
+                filled.put((buffer, n))
+                remaining -= n
+            filled.put(None)
+        except BaseException as e:
+            filled.put(e)
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = filled.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            buffer, n = item
+            yield memoryview(buffer)[:n]
+            free.put(buffer)
+    finally:
+        # wake up a reader waiting for a free buffer so it sees the stop
+        stop.set()
+        free.put(bytearray(chunk))
+        thread.join()
+
+
+class WriteBehind:
+    """
+    Run a `write(data, position)` function on a separate thread, up to `depth`
+    pieces behind the caller, so a slow disk doesn't stall the socket.
+    Pieces that are views of a reused receive buffer are copied into buffers of
+    its own first, bytes objects are queued as they are.
+    An error of the writer thread is raised by the next call.
+    """
+
+    def __init__(self, write, size, depth=DEFAULT_DEPTH):
+        self._write = write
+        self.size = size
+        self.queue = queue.Queue(maxsize=depth)
+        self.free = queue.Queue()
+        for _ in range(depth + 1):
+            self.free.put(bytearray(size))
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            data, position, buffer = item
+            if self.error is None:
+                try:
+                    self._write(data, position)
+                except BaseException as e:
+                    self.error = e
+            if buffer is not None:
+                self.free.put(buffer)
+
+    def write(self, data, position):
+        if self.error is not None:
+            raise self.error
+        buffer = None
+        if not isinstance(data, bytes):
+            n = len(data)
+            if n <= self.size:
+                buffer = self.free.get()
+                buffer[:n] = data
+                data = memoryview(buffer)[:n]
+            else:
+                data = bytes(data)
+        self.queue.put((data, position, buffer))
+
+    def close(self):
+        """
+        Wait until everything queued is written.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,69 @@
+import time
+
+REPORT_INTERVAL = 0.1  # seconds between progress reports, 10 per second
+SMOOTHING = 0.3  # weight of the latest rate in the moving average
+
+
+class ProgressReporter:
+    """
+    Turn the running byte count of a transfer into progress dicts at a fixed rate,
+    so consumers such as the terminal bar are not called for every chunk.
+    Besides "current" and "total" a report carries the "rate" since the previous
+    report, an exponentially weighted moving average "speed" in bytes per second,
+    and the "eta" in seconds, None while nothing moves.
+    """
+
+    def __init__(self, total, current=0, interval=REPORT_INTERVAL, smoothing=SMOOTHING):
+        self.total = total
+        self.interval = interval
+        self.smoothing = smoothing
+        self.speed = None
+        self.last_time = time.perf_counter()
+        self.last_current = current  # e.g. the offset a resumed transfer starts at
+
+    def update(self, current, force=False):
+        """
+        Returns a progress dict if one is due, i.e. the interval has passed, the
+        transfer is complete or `force` is set, otherwise None. Transfers without
+        data are never reported, there is no progress to show.
+        """
+        if not self.total:
+            return None
+        now = time.perf_counter()
+        elapsed = now - self.last_time
+        if elapsed < self.interval and current < self.total and not force:
+            return None
+        rate = (current - self.last_current) / max(elapsed, 1e-6)
+        if self.speed is None:
+            self.speed = rate
+        else:
+            self.speed += self.smoothing * (rate - self.speed)
+        self.last_time = now
+        self.last_current = current
+        eta = None
+        if self.speed > 0:
+            eta = max(self.total - current, 0) / self.speed
+        return {
+            "current": current,
+            "total": self.total,
+            "rate": rate,
+            "speed": self.speed,
+            "eta": eta,
+        }
+
+
+def throttle(counts, total, current=0, interval=REPORT_INTERVAL):
+    """
+    Yields progress dicts for an iterable of running byte counts at most every
+    `interval` seconds, always including the last count.
+    """
+    reporter = ProgressReporter(total, current, interval)
+    report = last = None
+    for last in counts:
+        report = reporter.update(last)
+        if report is not None:
+            yield report
+    if last is not None and report is None:
+        report = reporter.update(last, force=True)
+        if report is not None:
+            yield report
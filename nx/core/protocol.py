@@ -0,0 +1,321 @@
+import contextlib
+import io
+import json
+import struct
+import threading
+
+from .compression import COMPRESS_BLOCK
+
+# Every frame starts with a fixed size header followed by `length` bytes of payload:
+# magic (2 bytes) | version (1) | frame type (1) | flags (1) | length (8)
+MAGIC = b"NX"
+VERSION = 1
+HEADER = struct.Struct("!2sBBBQ")
+
+# frame types
+METADATA = 1
+ACK = 2
+DATA = 3
+TRAILER = 4
+ERROR = 5
+REF = 6  # a run of blocks the receiver copies from its existing copy of the file
+
+# frame flags
+COMPRESSED = 0x01  # the payload of a DATA frame is compressed with the session codec
+
+FRAME_NAMES = {
+    METADATA: "METADATA",
+    ACK: "ACK",
+    DATA: "DATA",
+    TRAILER: "TRAILER",
+    ERROR: "ERROR",
+    REF: "REF",
+}
+
+# payload of a REF frame: first block index | block count
+REF_PAYLOAD = struct.Struct("!QI")
+
+POOL_BUFFERS = 8  # spare buffers kept per buffer size
+
+# Payloads received whole are checked against these limits before their buffer is
+# allocated, so a peer can't make us allocate whatever its 64-bit length says.
+# METADATA, ACK, TRAILER, ERROR and REF frames. The largest are the chunk list of a
+# --dedup transfer, about 240 mb for a 100 gb file, and the manifest of a big tree.
+MAX_CONTROL_FRAME = 1024 * 1024 * 256
+# a compressed DATA frame holds one COMPRESS_BLOCK, blocks that don't shrink are
+# sent raw, so this leaves room for codec overhead
+MAX_COMPRESSED_FRAME = COMPRESS_BLOCK * 2
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RemoteError(ProtocolError):
+    """
+    Raised when the peer answers with an ERROR frame.
+    """
+
+    def __init__(self, message, details=None):
+        super().__init__(message)
+        self.details = details or {}
+
+
+class BufferPool:
+    """
+    Reusable bytearrays of one size, so hot loops don't allocate a new object for
+    every chunk they send or receive. At most `count` spare buffers are kept, extra
+    ones are left to the garbage collector when they are returned.
+    """
+
+    def __init__(self, size, count=POOL_BUFFERS):
+        self.size = size
+        self.count = count
+        self.free = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def borrow(self):
+        """
+        Lend a buffer for the duration of a with block. Views of it must not be kept
+        past the block.
+        """
+        with self.lock:
+            buffer = self.free.pop() if self.free else None
+        if buffer is None:
+            buffer = bytearray(self.size)
+        try:
+            yield buffer
+        finally:
+            with self.lock:
+                if len(self.free) < self.count:
+                    self.free.append(buffer)
+
+
+_pools = {}  # buffer size -> BufferPool shared by all transfers
+_pools_lock = threading.Lock()
+
+
+def borrow_buffer(size):
+    """
+    Borrow a buffer of `size` bytes from the shared pool for that size, e.g.
+    `with borrow_buffer(chunk) as buffer:`.
+    """
+    with _pools_lock:
+        pool = _pools.get(size)
+        if pool is None:
+            pool = _pools[size] = BufferPool(size)
+    return pool.borrow()
+
+
+def pack_header(frame_type, length, flags=0):
+    return HEADER.pack(MAGIC, VERSION, frame_type, flags, length)
+
+
+def send_frame(sock, frame_type, payload=b"", flags=0):
+    sock.sendall(pack_header(frame_type, len(payload), flags) + payload)
+
+
+def send_json(sock, frame_type, data):
+    send_frame(sock, frame_type, json.dumps(data).encode())
+
+
+def send_error(sock, message, **details):
+    send_json(sock, ERROR, {"error": message, **details})
+
+
+def check_length(length, limit=MAX_CONTROL_FRAME):
+    """
+    Raise ProtocolError if a payload received whole is longer than `limit`.
+    """
+    if length > limit:
+        raise ProtocolError(
+            f"Frame payload of {length} bytes exceeds the limit of {limit} bytes."
+        )
+
+
+def recv_exact(sock, size, limit=MAX_CONTROL_FRAME):
+    """
+    Receive exactly `size` bytes, raising ConnectionError if the peer closes early
+    and ProtocolError if `size` is over `limit`.
+    """
+    check_length(size, limit)
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Connection closed by peer.")
+        received += n
+    return bytes(buffer)
+
+
+def recv_header(sock):
+    """
+    Receive a frame header. Returns a tuple of (frame type, flags, payload length).
+    """
+    return unpack_header(recv_exact(sock, HEADER.size))
+
+
+def unpack_header(data):
+    """
+    Parse and check a frame header. Returns a tuple of (frame type, flags, length).
+    """
+    magic, version, frame_type, flags, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Invalid frame. Is the peer running nx?")
+    if version != VERSION:
+        raise ProtocolError(
+            f"Unsupported protocol version {version}. Expected {VERSION}."
+        )
+    if frame_type not in FRAME_NAMES:
+        raise ProtocolError(f"Unknown frame type {frame_type}.")
+    return frame_type, flags, length
+
+
+def iter_payload(sock, length, chunk, buffer=None):
+    """
+    Receive a frame payload in pieces of at most `chunk` bytes.
+    With a buffer the pieces are received into it with recv_into and yielded as
+    memoryviews of it, which are only valid until the next piece is received.
+    """
+    remaining = length
+    if buffer is not None:
+        view = memoryview(buffer)
+        chunk = min(chunk, len(buffer))
+        while remaining > 0:
+            n = sock.recv_into(view, min(chunk, remaining))
+            if n == 0:
+                raise ConnectionError("Connection closed by peer.")
+            remaining -= n
+            yield view[:n]
+        return
+    while remaining > 0:
+        data = sock.recv(min(chunk, remaining))
+        if not data:
+            raise ConnectionError("Connection closed by peer.")
+        remaining -= len(data)
+        yield data
+
+
+def iter_data(sock, flags, length, chunk, decompress=None, buffer=None):
+    """
+    Receive the payload of a DATA frame as raw data. Compressed frames are read whole
+    and decompressed, others come in pieces of at most `chunk` bytes, received into
+    `buffer` if one is given (see iter_payload).
+    """
+    if not flags & COMPRESSED:
+        return iter_payload(sock, length, chunk, buffer)
+    if decompress is None:
+        raise ProtocolError("Received a compressed frame without a codec.")
+    payload = recv_exact(sock, length, MAX_COMPRESSED_FRAME)
+    try:
+        return iter([decompress(payload)])
+    except ValueError as e:
+        raise ProtocolError(str(e))
+
+
+class DataReader(io.RawIOBase):
+    """
+    Read-only file object over consecutive DATA frames, e.g. to unpack an archive while
+    it is being received. Reading stops at the first frame that is not DATA, which is
+    kept in `end` as a tuple of (frame type, payload length).
+    If a hasher is given, every byte read is fed into it.
+    Compressed frames are decompressed with `decompress`.
+    """
+
+    def __init__(self, sock, hasher=None, decompress=None):
+        super().__init__()
+        self.sock = sock
+        self.hasher = hasher
+        self.decompress = decompress
+        self.remaining = 0
+        self.pending = b""
+        self.end = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.remaining == 0 and not self.pending:
+            if self.end is not None:
+                return 0
+            frame_type, flags, length = recv_header(self.sock)
+            if frame_type != DATA:
+                self.end = (frame_type, length)
+                return 0
+            if flags & COMPRESSED:
+                (data,) = iter_data(self.sock, flags, length, length, self.decompress)
+                self.pending = memoryview(data)
+            else:
+                self.remaining = length
+        if self.pending:
+            n = min(len(buffer), len(self.pending))
+            buffer[:n] = self.pending[:n]
+            if self.hasher is not None:
+                self.hasher.update(self.pending[:n])
+            self.pending = self.pending[n:]
+            return n
+        view = memoryview(buffer)[: min(len(buffer), self.remaining)]
+        n = self.sock.recv_into(view)
+        if n == 0:
+            raise ConnectionError("Connection closed by peer.")
+        if self.hasher is not None:
+            self.hasher.update(view[:n])
+        self.remaining -= n
+        return n
+
+    def drain(self, chunk=1024 * 64):
+        """
+        Skip the rest of the DATA frames. Returns the terminating frame.
+        """
+        while self.read(chunk):
+            pass
+        return self.end
+
+
+def recv_frame(sock):
+    """
+    Receive a whole frame. Returns a tuple of (frame type, payload).
+    """
+    frame_type, _, length = recv_header(sock)
+    return frame_type, recv_exact(sock, length)
+
+
+def recv_pending_error(sock, timeout=1):
+    """
+    Look for an ERROR frame the peer sent before dropping the connection.
+    Other frames are skipped. Returns a RemoteError, or None if there is none.
+    """
+    try:
+        sock.settimeout(timeout)
+        while True:
+            frame_type, payload = recv_frame(sock)
+            if frame_type == ERROR:
+                data = json.loads(payload.decode())
+                return RemoteError(data.get("error", "Unknown error."), data)
+    except (OSError, ProtocolError, ValueError):
+        return None
+
+
+def decode_json(frame_type, payload, expected):
+    """
+    Decode a JSON payload, raising RemoteError for ERROR frames and
+    ProtocolError if the frame is not of the expected type.
+    """
+    data = json.loads(payload.decode()) if payload else {}
+    if not isinstance(data, dict):
+        raise ProtocolError(f"Invalid {FRAME_NAMES[frame_type]} frame.")
+    if frame_type == ERROR:
+        raise RemoteError(data.get("error", "Unknown error."), data)
+    if frame_type != expected:
+        raise ProtocolError(
+            f"Expected {FRAME_NAMES[expected]} frame but got {FRAME_NAMES[frame_type]}."
+        )
+    return data
+
+
+def recv_json(sock, expected):
+    frame_type, payload = recv_frame(sock)
+    return decode_json(frame_type, payload, expected)
@@ -1,189 +1,1921 @@
-import json
+import mmap
 import os
+import queue
 import socket
+import stat
+import tarfile
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
+from . import (
+    compression,
+    dedup,
+    delta,
+    file_index,
+    metrics,
+    pipeline,
+    progress,
+    protocol,
+    tuning,
+)
 from . import utilities as utils
 
+SENDFILE_BLOCK = 1024 * 1024 * 8  # bytes handed to the kernel per sendfile call
+MIN_STREAM_SIZE = 1024 * 1024 * 4  # smallest byte range worth its own connection
+ARCHIVE_BLOCK = 1024 * 1024  # bytes of a streamed archive sent per DATA frame
+JOIN_TIMEOUT = 30  # seconds to wait for the extra connections of a session
+PARTIAL_SUFFIX = ".nxpart"  # sidecar state of a partially received file
+DELTA_SUFFIX = (
+    ".nxdelta"  # file rebuilt by a delta transfer before it replaces the copy
+)
+CHECKPOINT_INTERVAL = 1024 * 1024 * 64  # bytes received between sidecar updates
+SERVE_WORKERS = 8  # transfers a receive server handles at the same time
+ACCEPT_INTERVAL = 1  # seconds between checks whether a receive server should stop
 
-def send_file_tcp(ip, port: int, file_path, chunk, zip_mode=False, verbose=False):
-    chunk = chunk * 1024  # convert to bytes
+
+def can_sendfile(f):
+    """
+    Check if the kernel zero-copy sendfile path can be used for the given file object.
+    """
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (OSError, AttributeError, ValueError):
+        return False
+
+
+def send_file_data(
+    sock,
+    f,
+    file_size,
+    chunk,
+    zero_copy=True,
+    hasher=None,
+    offset=0,
+    read_ahead=0,
+):
+    """
+    Stream `file_size` bytes of an opened file, starting at `offset`, through a socket.
+    If a hasher is given, the data is hashed inline as it is sent.
+    With `read_ahead`, the file is read up to that many chunks ahead of the socket
+    on a separate thread, or with sendfile the kernel is asked to prefetch that many
+    blocks.
+    Yields the number of bytes sent so far.
+    """
+    sent = 0
+    if zero_copy and hasher is None and can_sendfile(f):
+        # let the kernel copy directly from the page cache into the socket
+        block = max(chunk, SENDFILE_BLOCK)
+        while sent < file_size:
+            count = min(block, file_size - sent)
+            if read_ahead and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(
+                    f.fileno(),
+                    offset + sent + count,
+                    read_ahead * block,
+                    os.POSIX_FADV_WILLNEED,
+                )
+            n = sock.sendfile(f, offset + sent, count)
+            if n == 0:
+                break
+            sent += n
+            yield sent
+        return
+
+    if read_ahead:
+        for data in pipeline.read_ahead(f, offset, file_size, chunk, read_ahead):
+            sock.sendall(data)
+            if hasher is not None:
+                hasher.update(data)
+            sent += len(data)
+            yield sent
+        return
+
+    # fallback: read into a pooled buffer and send from views of it
+    f.seek(offset)
+    with protocol.borrow_buffer(chunk) as buffer:
+        view = memoryview(buffer)
+        while sent < file_size:
+            n = f.readinto(view[: min(chunk, file_size - sent)])
+            if not n:
+                break
+            data = view[:n]
+            sock.sendall(data)
+            if hasher is not None:
+                hasher.update(data)
+            sent += n
+            yield sent
+
+
+def split_ranges(file_size, streams):
+    """
+    Split a file into at most `streams` contiguous byte ranges of [offset, length].
+    """
+    streams = max(1, min(streams, file_size // MIN_STREAM_SIZE))
+    if streams == 1:
+        return [[0, file_size]]
+    size = -(-file_size // streams)  # ceil division
+    return [
+        [offset, min(size, file_size - offset)] for offset in range(0, file_size, size)
+    ]
+
+
+if hasattr(os, "pwrite"):
+
+    def write_at(f, data, offset, lock=None):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(f.fileno(), view, offset)
+            view = view[n:]
+            offset += n
+
+else:
+
+    def write_at(f, data, offset, lock=None):
+        # no positional writes on this platform, serialize seek + write instead
+        with lock:
+            f.seek(offset)
+            f.write(data)
+
+
+def preallocate(f, size):
+    """
+    Reserve the full size of a file before it is written, so the filesystem can lay
+    it out in one piece instead of growing it write by write. Where fallocate isn't
+    supported the file is extended with truncate instead.
+    """
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass  # e.g. not supported by the filesystem
+    f.truncate(size)
+
+
+def run_streams(jobs, results):
+    """
+    Run generator jobs, one thread per job when there is more than one.
+    Each job yields the number of bytes it processed since its previous yield.
+    Yields the running total over all jobs and collects their return values
+    in `results`.
+    """
+    results.extend([None] * len(jobs))
+    total = 0
+    if len(jobs) == 1:
+        job = jobs[0]
+        while True:
+            try:
+                total += next(job)
+            except StopIteration as stop:
+                results[0] = stop.value
+                return
+            yield total
+
+    events = queue.Queue()
+
+    def worker(index, job):
+        try:
+            while True:
+                try:
+                    events.put(("progress", next(job)))
+                except StopIteration as stop:
+                    results[index] = stop.value
+                    break
+            events.put(("done", None))
+        except BaseException as e:
+            events.put(("error", e))
+
+    for index, job in enumerate(jobs):
+        threading.Thread(target=worker, args=(index, job), daemon=True).start()
+
+    running = len(jobs)
+    while running:
+        event, value = events.get()
+        if event == "progress":
+            total += value
+            yield total
+        elif event == "done":
+            running -= 1
+        else:
+            raise value
+
+
+def send_range(
+    sock,
+    file_path,
+    offset,
+    length,
+    chunk,
+    zero_copy,
+    algo,
+    file_hash,
+    hasher,
+    ack_pending,
+    compressor=None,
+    jobs=1,
+    tuner=None,
+    read_ahead=0,
+    meter=None,
+):
+    """
+    Send one byte range of a file as DATA frames followed by its TRAILER, then
+    wait for the receiver to validate it.
+    If a hasher is given, the range is hashed while sending and its digest replaces
+    `file_hash` in the trailer.
+    Yields the number of bytes sent since the previous yield.
+    Returns the validation result.
+    """
+    yield from send_data(
+        sock,
+        file_path,
+        offset,
+        length,
+        chunk,
+        zero_copy,
+        hasher,
+        compressor,
+        jobs,
+        tuner,
+        read_ahead,
+        meter,
+    )
+    return finish_send(sock, algo, file_hash, hasher, ack_pending)
+
+
+def send_data(
+    sock,
+    file_path,
+    offset,
+    length,
+    chunk,
+    zero_copy,
+    hasher,
+    compressor=None,
+    jobs=1,
+    tuner=None,
+    read_ahead=0,
+    meter=None,
+):
+    """
+    Send one byte range of a file as a single DATA frame, or block by block as
+    separately compressed frames if a compressor is given.
+    With a tuner the first PROBE_BYTES go as a frame of their own, and the rest is
+    sent with the chunk size tuned to the throughput measured over them.
+    With a meter, the TransferMetrics of the transfer, reads of the file are recorded.
+    Yields the number of bytes sent since the previous yield.
+    """
+    with open(file_path, "rb") as f:
+        if meter is not None:
+            f = meter.file(f)
+        if compressor is not None:
+            # compression happens inline, block by block, so there is no pre-pass
+            blocks = iter_file_blocks(f, file_path, offset, length, hasher, compressor)
+            for sent, _ in send_blocks(sock, blocks, jobs):
+                yield sent
+            return
+
+        parts = [(offset, length)]
+        if tuner is not None and length > 2 * tuning.PROBE_BYTES:
+            probe = tuning.PROBE_BYTES
+            parts = [(offset, probe), (offset + probe, length - probe)]
+        for part_offset, part_length in parts:
+            start = time.perf_counter()
+            last = 0
+            sock.sendall(protocol.pack_header(protocol.DATA, part_length))
+            for sent in send_file_data(
+                sock, f, part_length, chunk, zero_copy, hasher, part_offset, read_ahead
+            ):
+                yield sent - last
+                last = sent
+            if last != part_length:
+                raise protocol.ProtocolError(f"{file_path} changed while it was sent.")
+            if tuner is not None and part_length >= tuning.PROBE_BYTES:
+                chunk = tuner.tune(part_length, time.perf_counter() - start)
+
+
+def iter_file_blocks(f, file_path, offset, length, hasher, compressor):
+    """
+    Read a byte range of an opened file in blocks for send_blocks, hashing them in
+    order on the way.
+    """
+    f.seek(offset)
+    read = 0
+    while read < length:
+        data = f.read(min(compression.COMPRESS_BLOCK, length - read))
+        if not data:
+            raise protocol.ProtocolError(f"{file_path} changed while it was sent.")
+        if hasher is not None:
+            hasher.update(data)
+        read += len(data)
+        yield data, compressor, None
+
+
+def send_blocks(sock, blocks, jobs=1):
+    """
+    Compress blocks on `jobs` threads and send them as DATA frames in their original
+    order. `blocks` yields tuples of (data, compressor, tag), empty blocks only pass
+    their tag along.
+    Yields tuples of (bytes sent, tag) once a block is on its way.
+    """
+    for data, payload, compressed, tag in compression.compress_blocks(blocks, jobs):
+        if data:
+            flags = protocol.COMPRESSED if compressed else 0
+            protocol.send_frame(sock, protocol.DATA, payload, flags)
+        yield len(data), tag
+
+
+def send_manifest(
+    sock,
+    manifest,
+    sources,
+    chunk,
+    zero_copy,
+    algo,
+    inline,
+    ack_pending,
+    codec="none",
+    adaptive=False,
+    jobs=1,
+    read_ahead=0,
+    meter=None,
+):
+    """
+    Send the files of a manifest back to back, each as DATA frames followed by its
+    own TRAILER, then wait for the receiver to validate them. `sources` holds the
+    local path of every manifest entry.
+    When compressing, the blocks of all files share one pipeline, so small files are
+    compressed in parallel too. In adaptive mode every file decides on its own
+    whether it's worth compressing.
+    Yields the number of bytes sent since the previous yield.
+    Returns the validation result.
+    """
+    files = [
+        (path, entry)
+        for path, entry in zip(sources, manifest)
+        if entry["type"] == "file"
+    ]
+    if codec != "none":
+        blocks = iter_manifest_blocks(files, algo, inline, codec, adaptive)
+        for sent, trailer in send_blocks(sock, blocks, jobs):
+            if trailer is not None:
+                protocol.send_json(sock, protocol.TRAILER, trailer)
+            if sent:
+                yield sent
+    else:
+        for path, entry in files:
+            hasher = utils.new_hasher(algo) if inline else None
+            yield from send_data(
+                sock,
+                path,
+                0,
+                entry["size"],
+                chunk,
+                zero_copy,
+                hasher,
+                read_ahead=read_ahead,
+                meter=meter,
+            )
+            file_hash = hasher.hexdigest() if hasher is not None else entry["hash"]
+            trailer = {"hash_algo": algo, "hash": file_hash}
+            protocol.send_json(sock, protocol.TRAILER, trailer)
+
+    if ack_pending:
+        protocol.recv_json(sock, protocol.ACK)
+    return protocol.recv_json(sock, protocol.ACK)
+
+
+def iter_manifest_blocks(files, algo, inline, codec, adaptive):
+    """
+    Read the files of a manifest, given as tuples of (local path, entry), in blocks
+    for send_blocks. Every file ends with an empty block tagged with its trailer.
+    """
+    for path, entry in files:
+        hasher = utils.new_hasher(algo) if inline else None
+        compressor = compression.new_compressor(codec, adaptive, entry["path"])
+        with open(path, "rb") as f:
+            yield from iter_file_blocks(f, path, 0, entry["size"], hasher, compressor)
+        file_hash = hasher.hexdigest() if hasher is not None else entry["hash"]
+        yield b"", None, {"hash_algo": algo, "hash": file_hash}
+
+
+def send_tar(sock, dir_path, chunk, algo, hasher, ack_pending, compressor=None, jobs=1):
+    """
+    Pack a directory into a tar stream while sending it as DATA frames, followed by
+    its TRAILER, then wait for the receiver to validate it.
+    Yields the number of file bytes packed since the previous yield.
+    Returns the validation result.
+    """
+
+    # receivers reject compressed frames that decompress to more than COMPRESS_BLOCK
+    block = (
+        max(chunk, ARCHIVE_BLOCK) if compressor is None else compression.COMPRESS_BLOCK
+    )
+
+    def iter_blocks():
+        for data, processed in utils.iter_tar_dir(dir_path, block):
+            if hasher is not None:
+                hasher.update(data)
+            yield data, compressor, processed
+
+    last = 0
+    for _, processed in send_blocks(sock, iter_blocks(), jobs):
+        if processed > last:
+            yield processed - last
+            last = processed
+    return finish_send(sock, algo, None, hasher, ack_pending)
+
+
+def send_delta(
+    sock, file_path, signatures, block, algo, file_hash, hasher, compressor=None
+):
+    """
+    Send a file as the difference to the receiver's copy: REF frames for blocks
+    matching its signatures and DATA frames for everything else, followed by the
+    TRAILER, then wait for the receiver to validate the rebuilt file.
+    Yields the number of file bytes covered since the previous yield.
+    Returns the validation result.
+    """
+    position = 0
+    with open(file_path, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as data:
+        for op, first, second in delta.iter_delta(data, signatures, block):
+            if op == "ref":
+                payload = protocol.REF_PAYLOAD.pack(first, second)
+                protocol.send_frame(sock, protocol.REF, payload)
+                end = position + second * block
+            else:
+                end = second
+                payload, compressed = data[first:second], False
+                if compressor is not None:
+                    payload, compressed = compressor.compress(payload)
+                flags = protocol.COMPRESSED if compressed else 0
+                protocol.send_frame(sock, protocol.DATA, payload, flags)
+            if hasher is not None:
+                hasher.update(data[position:end])
+            yield end - position
+            position = end
+    return finish_send(sock, algo, file_hash, hasher, False)
+
+
+def send_chunks(
+    sock, file_path, chunks, missing, algo, file_hash, hasher, compressor=None
+):
+    """
+    Send the chunks of a file that are missing from the receiver's chunk store as DATA
+    frames, each one only once, followed by the TRAILER, then wait for the receiver
+    to rebuild and validate the file.
+    Yields the number of file bytes covered since the previous yield.
+    Returns the validation result.
+    """
+    missing = set(missing)
+    with open(file_path, "rb") as f:
+        for digest, size in chunks:
+            if digest not in missing and hasher is None:
+                f.seek(size, os.SEEK_CUR)
+                yield size
+                continue
+            data = f.read(size)
+            if hasher is not None:
+                hasher.update(data)
+            if digest in missing:
+                missing.discard(digest)
+                payload, compressed = data, False
+                if compressor is not None:
+                    payload, compressed = compressor.compress(data)
+                flags = protocol.COMPRESSED if compressed else 0
+                protocol.send_frame(sock, protocol.DATA, payload, flags)
+            yield size
+    return finish_send(sock, algo, file_hash, hasher, False)
+
+
+def finish_send(sock, algo, file_hash, hasher, ack_pending):
+    """
+    Send the hash trailer and wait for the validation result.
+    """
+    if hasher is not None:
+        file_hash = hasher.hexdigest()
+    protocol.send_json(sock, protocol.TRAILER, {"hash_algo": algo, "hash": file_hash})
+
+    # a pipelined acknowledgment is queued before the validation result
+    if ack_pending:
+        protocol.recv_json(sock, protocol.ACK)
+    return protocol.recv_json(sock, protocol.ACK)
+
+
+def send_file_tcp(
+    ip,
+    port: int,
+    file_path,
+    chunk,
+    zip_mode=False,
+    verbose=False,
+    zero_copy=True,
+    inline_hash=False,
+    hash_algo="auto",
+    streams=1,
+    resume=False,
+    tar_mode=False,
+    compress="none",
+    jobs=compression.DEFAULT_JOBS,
+    delta_mode=False,
+    dedup_mode=False,
+    sync_mode=False,
+    read_ahead=pipeline.DEFAULT_DEPTH,
+    meter=None,
+):
+    chunk = tuning.chunk_bytes(chunk)  # convert to bytes
+    auto_chunk = chunk == tuning.AUTO
+    if auto_chunk:
+        chunk = tuning.START_CHUNK
+    if hash_algo not in ("auto", "none") + tuple(utils.available_hash_algos()):
+        print(f"Hash algorithm {hash_algo} is not available. Install nx[fast-hash].")
+        return
+    if compress not in ("auto", "none") + tuple(compression.available_codecs()):
+        print(f"Compression codec {compress} is not available. Install nx[compress].")
+        return
+    if resume and streams > 1:
+        print("Resume is not supported with multiple streams.")
+        return
+
+    # several paths are sent together as one manifest over a single connection
+    paths = [file_path] if isinstance(file_path, str) else list(file_path)
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"{path} does not exist.")
+            return
+    batch = len(paths) > 1
+    names = [os.path.basename(os.path.normpath(path)) for path in paths]
+    if len(set(names)) < len(names):
+        print("Paths sent together need different names.")
+        return
+    if batch and (streams > 1 or resume or zip_mode or tar_mode):
+        print("Streams, resume, zip and tar only work when sending a single path.")
+        return
+    if delta_mode and (batch or os.path.isdir(paths[0]) or streams > 1 or resume):
+        print("Delta only works for single files without --streams or --resume.")
+        return
+    if dedup_mode and (
+        batch or os.path.isdir(paths[0]) or streams > 1 or resume or delta_mode
+    ):
+        print(
+            "Dedup only works for single files without --streams, --resume or --delta."
+        )
+        return
+    if sync_mode and (
+        zip_mode or tar_mode or streams > 1 or resume or delta_mode or dedup_mode
+    ):
+        print("Sync sends files one by one, it can't be combined with other modes.")
+        return
+    if sync_mode:
+        # the receiver compares the hashes before any data is sent
+        inline_hash = False
+    # socket and disk calls are only recorded when metrics were asked for
+    metered = meter is not None
+    meter = meter or metrics.TransferMetrics("sender")
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if metered:
+        sock = meter.socket(sock)
+    socks = [sock]
     if verbose:
         print("TCP Socket created.")
+    file_path = os.path.normpath(paths[0])
+    if batch:
+        file_path = f"{len(paths)} paths"
     if verbose:
         print(f"Sending {file_path} to {ip}:{port}")
-    is_dir = os.path.isdir(file_path)
+    is_dir = not batch and os.path.isdir(file_path)
+    archive = "manifest" if batch or sync_mode else None
     try:
         msg = "Connecting..."
         print(msg, end="\r")
+        meter.enter("connect")
+        connect_time = time.perf_counter()
         sock.connect((ip, port))
+        # the TCP handshake takes one round trip
+        rtt = time.perf_counter() - connect_time
         print("Connected.".ljust(len(msg)))
+        tuner = None
+        if auto_chunk:
+            tuning.set_nodelay(sock)
+            tuner = tuning.LinkTuner(socks, rtt, socket.SO_SNDBUF, verbose)
 
-        # check if path is a directory, if so zip it
+        # check if path is a directory, if so send it file by file, as tar or zipped
+        if is_dir and (streams > 1 or resume) and not zip_mode:
+            print("Streams and resume only work for files and zipped directories.")
+            return
         if is_dir:
-            if zip_mode:
+            if tar_mode:
+                if verbose:
+                    print("Path is a directory. Streaming as tar...")
+                archive = "tar"
+                # the archive only exists while it is sent, so it can't be prehashed
+                inline_hash = True
+            elif zip_mode:
                 if verbose:
                     print("Path is a directory. Zipping...")
-                file_path = utils.zip_dir(file_path, file_path + ".zip")
+                archive = "zip"
+                meter.enter("zip")
+                # leave the compression to the transfer stream if it's enabled
+                file_path = utils.zip_dir(
+                    file_path, file_path + ".zip", stored=compress != "none"
+                )
                 print("")  # newline
             else:
-                print("Path is a directory. Use -z or --zip to zip before sending.")
-                sock.close()
-                return
+                if verbose:
+                    print("Path is a directory. Sending files...")
+                archive = "manifest"
 
         # prepare metadata
-        file_size = os.path.getsize(file_path)
+        # With inline hashing the hash is computed while sending and sent in the
+        # trailer, which also lets the receiver pick the algorithm on auto.
+        # With several streams every byte range is hashed and validated on its own.
+        # Streamed archives report the total uncompressed size.
+        meter.enter("hash")
+        if archive == "manifest":
+            manifest, sources = utils.build_batch_manifest(paths)
+            file_size = sum(entry["size"] for entry in manifest)
+        elif archive == "tar":
+            file_size = utils.get_dir_size(file_path)
+        else:
+            file_size = os.path.getsize(file_path)
+        ranges = split_ranges(file_size, streams)
         metadata = {
             "name": os.path.basename(file_path),
             "size": file_size,
-            "hash": utils.get_hash(file_path),
+            "mtime": os.path.getmtime(paths[0]),
+            "hash": None,
+            "hash_algo": hash_algo,
             "is_dir": is_dir,
+            "archive": archive,
+            "resume": resume,
+            "compress": compress,
+            "delta": delta_mode,
+            "dedup": dedup_mode,
+            "sync": sync_mode,
+            "rtt": rtt,
         }
+        if archive == "manifest":
+            metadata["manifest"] = manifest
+        if archive in ("tar", "manifest"):
+            ranges = [[0, file_size]]
+        if len(ranges) > 1:
+            metadata["session"] = uuid.uuid4().hex
+            metadata["ranges"] = ranges
+        if hash_algo == "auto":
+            if inline_hash:
+                metadata["hash_algos"] = utils.available_hash_algos()
+            else:
+                metadata["hash_algo"] = utils.DEFAULT_HASH_ALGO
+        if compress == "auto":
+            metadata["codecs"] = compression.available_codecs()
+        hashes = [None] * len(ranges)
+        if archive == "manifest" and not inline_hash:
+            # a sync only rehashes files that changed since they were last hashed
+            index = file_index.FileIndex() if sync_mode else None
+            for path, entry in zip(sources, manifest):
+                if entry["type"] != "file":
+                    continue
+                if index is not None:
+                    entry["hash"] = index.get_hash(path, metadata["hash_algo"])
+                else:
+                    entry["hash"] = utils.get_hash(path, metadata["hash_algo"])
+            if index is not None:
+                index.close()
+        elif dedup_mode:
+            # the file hash is computed in the same pass that splits it into chunks
+            hasher = None
+            if not inline_hash:
+                hasher = utils.new_hasher(metadata["hash_algo"])
+            metadata["chunks"] = dedup.chunk_file(file_path, hasher)
+            if hasher is not None:
+                metadata["hash"] = hashes[0] = hasher.hexdigest()
+        elif not inline_hash:
+            hashes = [
+                utils.get_hash(file_path, metadata["hash_algo"], offset=o, length=n)
+                for o, n in ranges
+            ]
+            if len(ranges) == 1:
+                metadata["hash"] = hashes[0]
 
         # send metadata
         msg = "Sending metadata..."
         if verbose:
             print(msg, end="\r")
-        sock.sendall(json.dumps(metadata).encode())
+        meter.enter("metadata")
+        protocol.send_json(sock, protocol.METADATA, metadata)
         if verbose:
             print("Metadata sent.".ljust(len(msg)))
 
-        # wait for acknowledgment
-        msg = "Waiting for acknowledgment..."
-        if verbose:
-            print(msg, end="\r")
-        ack = sock.recv(1024)
-        if ack.decode() != "ACK":
-            print("Failed to receive acknowledgment.")
-            return
+        # the data is pipelined right behind the metadata. The acknowledgment is only
+        # awaited first when the receiver has to pick the hash algorithm or codec,
+        # tell where to resume from, send the signatures of its copy or list the
+        # chunks it is missing or the files it already has.
+        ack = None
+        algo = metadata["hash_algo"]
+        codec = compress
+        if (
+            algo == "auto"
+            or compress == "auto"
+            or resume
+            or delta_mode
+            or dedup_mode
+            or sync_mode
+        ):
+            ack = wait_for_ack(sock, verbose)
+            algo = ack["hash_algo"]
+            codec = ack.get("compress", "none")
         if verbose:
-            print("Acknowledgment received.".ljust(len(msg)))
+            print(f"Hash algorithm: {algo}")
+            print(f"Compression: {codec}")
+            if codec != "none":
+                print(f"Compression jobs: {jobs}")
+
+        # leave out the files the receiver already has
+        unchanged = ack.get("sync") if sync_mode else None
+        if unchanged:
+            skipped = set(unchanged)
+            kept = [
+                position for position in range(len(manifest)) if position not in skipped
+            ]
+            sources = [sources[position] for position in kept]
+            manifest = [manifest[position] for position in kept]
+            file_size = sum(entry["size"] for entry in manifest)
+            print(f"Skipping {len(unchanged)} unchanged files.")
+
+        # an inline hash of the whole file has to cover the part already received
+        hashers = [utils.new_hasher(algo) if inline_hash else None for _ in ranges]
+        offset = ack.get("offset", 0) if resume else 0
+        if offset:
+            ranges = [[offset, file_size - offset]]
+            print("Resuming from {} {}.".format(*utils.convert_byte(offset, "auto")))
+            if hashers[0] is not None:
+                utils.update_hash(hashers[0], file_path, length=offset)
+
+        # open the extra connections of a multi-stream session
+        for stream in range(1, len(ranges)):
+            stream_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if metered:
+                stream_sock = meter.socket(stream_sock)
+            socks.append(stream_sock)
+            stream_sock.connect((ip, port))
+            if auto_chunk:
+                tuning.set_nodelay(stream_sock)
+            join = {"session": metadata["session"], "stream": stream}
+            protocol.send_json(stream_sock, protocol.METADATA, join)
 
         # send file
         if verbose:
-            print("Sending file...")
-
+            if (
+                zero_copy
+                and not inline_hash
+                and codec == "none"
+                and not delta_mode
+                and not dedup_mode
+                and hasattr(os, "sendfile")
+            ):
+                print("Sending file (zero-copy)...")
+            else:
+                print("Sending file...")
+            if len(ranges) > 1:
+                print(f"Using {len(ranges)} streams.")
+            if auto_chunk:
+                print(f"Chunk size: auto, starting at {chunk // 1024} kb.")
+        meter.enter("data")
         start_time = time.time()
-        with open(file_path, "rb") as f:
-            while True:
-                data = f.read(chunk)
-                if not data:
-                    break
-                sock.sendall(data)
-
-                # print progress
-                yield {"current": f.tell(), "total": file_size}
+        signatures = ack.get("delta") if delta_mode else None
+        if signatures and verbose:
+            block = utils.convert_byte(signatures["block"], "kb")
+            count = len(signatures["signatures"])
+            print("Delta against {} blocks of {} {}.".format(count, *block))
+        missing = ack.get("dedup") if dedup_mode else None
+        if missing is not None and verbose:
+            count = len({digest for digest, _ in metadata["chunks"]})
+            print(f"Sending {len(missing)} of {count} chunks.")
+        if missing is not None:
+            senders = [
+                send_chunks(
+                    sock,
+                    file_path,
+                    metadata["chunks"],
+                    missing,
+                    algo,
+                    hashes[0],
+                    hashers[0],
+                    compression.new_compressor(codec, compress == "auto", file_path),
+                )
+            ]
+        elif signatures and file_size:
+            senders = [
+                send_delta(
+                    sock,
+                    file_path,
+                    signatures["signatures"],
+                    signatures["block"],
+                    algo,
+                    hashes[0],
+                    hashers[0],
+                    compression.new_compressor(codec, compress == "auto", file_path),
+                )
+            ]
+        elif archive == "manifest":
+            senders = [
+                send_manifest(
+                    sock,
+                    manifest,
+                    sources,
+                    chunk,
+                    zero_copy,
+                    algo,
+                    inline_hash,
+                    ack is None,
+                    codec,
+                    compress == "auto",
+                    jobs,
+                    read_ahead,
+                    meter if metered else None,
+                )
+            ]
+        elif archive == "tar":
+            compressor = compression.new_compressor(codec, compress == "auto")
+            senders = [
+                send_tar(
+                    sock,
+                    file_path,
+                    chunk,
+                    algo,
+                    hashers[0],
+                    ack is None,
+                    compressor,
+                    jobs,
+                )
+            ]
+        else:
+            senders = [
+                send_range(
+                    s,
+                    file_path,
+                    o,
+                    n,
+                    chunk,
+                    zero_copy,
+                    algo,
+                    h,
+                    hr,
+                    s is sock and ack is None,
+                    compression.new_compressor(codec, compress == "auto", file_path),
+                    jobs,
+                    tuner,
+                    read_ahead,
+                    meter if metered else None,
+                )
+                for s, (o, n), h, hr in zip(socks, ranges, hashes, hashers)
+            ]
+        results = []
+        counts = (offset + sent for sent in run_streams(senders, results))
+        yield from progress.throttle(counts, file_size, offset)
         end_time = time.time()
         print(f"\ncomplete in {round(end_time - start_time, 2)} seconds. [{file_path}]")
 
-    except socket.error as e:
-        raise Exception(f"File transfer failed: {e}")
+        if verbose and all(result.get("validated") for result in results):
+            print("File validated by receiver.")
+
+    except protocol.RemoteError as e:
+        print_rejection(e)
+    except (socket.error, protocol.ProtocolError) as e:
+        # the receiver may have rejected the transfer while data was in flight
+        error = protocol.recv_pending_error(sock)
+        if error is None:
+            raise Exception(f"File transfer failed: {e}")
+        print_rejection(error)
     finally:
-        sock.close()
-        if is_dir and zip_mode and file_path.endswith(".zip"):
+        meter.finish()
+        close_sockets(socks)
+        if archive == "zip" and file_path.endswith(".zip"):
             os.remove(file_path)
         if verbose:
             print("TCP Socket closed.")
 
 
-def receive_file_tcp(port, save_dir, chunk, verbose=False):
-    chunk = chunk * 1024  # convert to bytes
+def close_sockets(socks):
+    # shut down first so threads blocked on these sockets wake up
+    for s in socks:
+        try:
+            s.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        s.close()
+
+
+def print_rejection(error):
+    print(f"\nReceiver error: {error}")
+    if "hash_algos" in error.details:
+        print(f"Receiver supports: {', '.join(error.details['hash_algos'])}")
+
+
+def wait_for_ack(sock, verbose=False):
+    msg = "Waiting for acknowledgment..."
+    if verbose:
+        print(msg, end="\r")
+    ack = protocol.recv_json(sock, protocol.ACK)
+    if verbose:
+        print("Acknowledgment received.".ljust(len(msg)))
+    return ack
+
+
+def get_supported_hash_algos(hash_algo="auto"):
+    """
+    Hash algorithms a receiver accepts for the given --hash option.
+    "none" on the receiver side accepts anything but skips validation.
+    """
+    if hash_algo == "auto":
+        return utils.available_hash_algos() + ["none"]
+    if hash_algo != "none" and hash_algo not in utils.available_hash_algos():
+        raise ValueError(f"Unsupported hash algorithm {hash_algo}")
+    return [hash_algo]
+
+
+def resolve_hash_algo(metadata, supported):
+    """
+    Decide which hash algorithm validates the transfer described by the metadata.
+    Returns None if the sender's algorithm is not accepted.
+    """
+    if supported == ["none"]:
+        return "none"
+    if metadata["hash_algo"] == "auto":
+        return utils.negotiate_hash_algo(metadata["hash_algos"], supported)
+    if metadata["hash_algo"] in supported:
+        return metadata["hash_algo"]
+    return None
+
+
+def resolve_codec(metadata):
+    """
+    Decide which compression codec the transfer described by the metadata uses.
+    Returns None if the sender's codec is not available.
+    """
+    codec = metadata.get("compress", "none")
+    if codec == "auto":
+        return compression.negotiate_codec(
+            metadata["codecs"], compression.available_codecs()
+        )
+    if codec == "none" or codec in compression.available_codecs():
+        return codec
+    return None
+
+
+def accept_streams(server_sock, session, count):
+    """
+    Accept the extra connections of a multi-stream session.
+    Returns the sockets ordered by their stream index.
+    """
+    streams = [None] * count
+    server_sock.settimeout(JOIN_TIMEOUT)
+    try:
+        for _ in range(count):
+            stream_sock, _ = server_sock.accept()
+            stream_sock.settimeout(None)
+            join = protocol.recv_json(stream_sock, protocol.METADATA)
+            index = join.get("stream", 0) - 1
+            if join.get("session") != session or not 0 <= index < count:
+                protocol.send_error(stream_sock, "Unknown transfer session.")
+                stream_sock.close()
+                raise protocol.ProtocolError("Stream does not belong to this session.")
+            streams[index] = stream_sock
+    except socket.timeout:
+        close_sockets([s for s in streams if s is not None])
+        raise protocol.ProtocolError("Timed out waiting for transfer streams.")
+    finally:
+        server_sock.settimeout(None)
+    return streams
+
+
+def read_blocks(file_path, block):
+    """
+    Returns a function reading runs of blocks of a file, the basis a delta transfer
+    copies unchanged blocks from. References past the whole blocks of the file, or
+    runs longer than the sender ever makes, are rejected before anything is read.
+    """
+    blocks = os.path.getsize(file_path) // block
+    max_run = max(1, delta.MAX_RUN_BYTES // block)
+
+    def basis(index, count):
+        if count > max_run or index + count > blocks:
+            raise protocol.ProtocolError("Block reference out of range.")
+        with open(file_path, "rb") as f:
+            f.seek(index * block)
+            data = f.read(count * block)
+        if len(data) != count * block:
+            raise protocol.ProtocolError("Block reference out of range.")
+        return data
+
+    return basis
+
+
+def read_partial_state(file_path):
+    """
+    Read the sidecar state of a partially received file. Returns None if there is none.
+    """
+    try:
+        return utils.read_json(file_path + PARTIAL_SUFFIX)
+    except (OSError, ValueError):
+        return None
+
+
+def write_partial_state(file_path, metadata, algo, received, hasher):
+    state = {
+        "name": metadata["name"],
+        "size": metadata["size"],
+        "mtime": metadata["mtime"],
+        "hash_algo": algo,
+        "received": received,
+        "hash": hasher.hexdigest() if hasher is not None else None,
+    }
+    utils.write_json(file_path + PARTIAL_SUFFIX, state)
+
+
+def remove_partial_state(file_path):
+    if os.path.exists(file_path + PARTIAL_SUFFIX):
+        os.remove(file_path + PARTIAL_SUFFIX)
+
+
+def find_resume_offset(file_path, metadata, algo):
+    """
+    Check the sidecar state of a partially received file against an incoming transfer.
+    Returns the offset to resume from, and a hasher that already covers the bytes
+    before it. The offset is 0 if the transfer has to start over.
+    """
+    hasher = utils.new_hasher(algo)
+    state = read_partial_state(file_path)
+    if state is None or not os.path.isfile(file_path):
+        return 0, hasher
+    keys = ["name", "size", "mtime"]
+    received = state.get("received", 0)
+    if [state.get(key) for key in keys] != [metadata.get(key) for key in keys]:
+        return 0, hasher
+    if os.path.getsize(file_path) < received:
+        return 0, hasher
+
+    # rehash the part on disk, which also catches a modified partial file
+    if hasher is not None:
+        utils.update_hash(hasher, file_path, length=received)
+        if state.get("hash_algo") == algo and hasher.hexdigest() != state.get("hash"):
+            return 0, utils.new_hasher(algo)
+    return received, hasher
+
+
+def receive_range(
+    sock,
+    write,
+    offset,
+    length,
+    chunk,
+    hasher,
+    file_hash=None,
+    decompress=None,
+    basis=None,
+    tuner=None,
+    write_behind=0,
+):
+    """
+    Receive the DATA frames of one byte range and its TRAILER, then validate the range
+    and answer with an ACK or ERROR frame.
+    Yields the number of bytes received since the previous yield.
+    Returns an error message if validation failed, otherwise None.
+    """
+    trailer = yield from receive_data(
+        sock,
+        write,
+        offset,
+        length,
+        chunk,
+        hasher,
+        decompress,
+        basis,
+        tuner,
+        write_behind,
+    )
+    return finish_receive(sock, hasher, trailer.get("hash") or file_hash)
+
+
+def receive_data(
+    sock,
+    write,
+    offset,
+    length,
+    chunk,
+    hasher,
+    decompress=None,
+    basis=None,
+    tuner=None,
+    write_behind=0,
+):
+    """
+    Receive DATA frames up to the next TRAILER, writing every piece at its position.
+    Raw data is received into a pooled buffer, compressed frames are decompressed
+    first, and the data is fed into the hasher before it is written.
+    In delta mode REF frames are resolved with `basis(index, count)`, which reads
+    blocks of the receiver's existing copy.
+    With a tuner the chunk size is tuned after the first frame of at least
+    PROBE_BYTES.
+    With `write_behind`, data larger than a chunk is written on a separate thread up
+    to that many pieces behind the socket.
+    Yields the number of bytes received since the previous yield.
+    Returns the trailer.
+    """
+    if write_behind and length > chunk:
+        writer = pipeline.WriteBehind(
+            write, tuning.MAX_CHUNK if tuner is not None else chunk, write_behind
+        )
+        try:
+            trailer = yield from receive_data(
+                sock,
+                writer.write,
+                offset,
+                length,
+                chunk,
+                hasher,
+                decompress,
+                basis,
+                tuner,
+            )
+        finally:
+            writer.close()
+        return trailer
+
+    position = offset
+
+    # data frames until the trailer
+    frame_type, flags, size = protocol.recv_header(sock)
+    while frame_type in (protocol.DATA, protocol.REF):
+        start = time.perf_counter()
+        with protocol.borrow_buffer(chunk) as buffer:
+            if frame_type == protocol.DATA:
+                pieces = protocol.iter_data(
+                    sock, flags, size, chunk, decompress, buffer
+                )
+            elif basis is not None:
+                payload = protocol.recv_exact(sock, size)
+                pieces = [basis(*protocol.REF_PAYLOAD.unpack(payload))]
+            else:
+                raise protocol.ProtocolError(
+                    "Received a block reference without a basis."
+                )
+            for data in pieces:
+                if hasher is not None:
+                    hasher.update(data)
+                write(data, position)
+                position += len(data)
+                yield len(data)
+        if tuner is not None and size >= tuning.PROBE_BYTES:
+            chunk = tuner.tune(size, time.perf_counter() - start)
+        frame_type, flags, size = protocol.recv_header(sock)
+
+    # read hash trailer
+    payload = protocol.recv_exact(sock, size)
+    trailer = protocol.decode_json(frame_type, payload, protocol.TRAILER)
+    if position - offset != length:
+        raise protocol.ProtocolError(
+            f"Received {position - offset} bytes but expected {length}."
+        )
+    return trailer
+
+
+def receive_manifest(
+    sock,
+    save_dir,
+    manifest,
+    chunk,
+    algo,
+    decompress=None,
+    sync=False,
+    write_behind=0,
+    meter=None,
+):
+    """
+    Recreate the tree of a directory manifest while its files arrive back to back,
+    validating every file on its own, then answer with an ACK or ERROR frame.
+    For a sync the hashes of validated files are recorded in the file index, so the
+    next sync doesn't hash them again.
+    With a meter, the TransferMetrics of the transfer, disk writes are recorded.
+    Yields the number of bytes received since the previous yield.
+    Returns an error message listing the files that failed validation, otherwise None.
+    """
+    errors = []
+    validated = []
+    for entry in manifest:
+        try:
+            path = utils.safe_join(save_dir, entry["path"])
+        except ValueError as e:
+            raise protocol.ProtocolError(str(e))
+        if entry["type"] == "dir":
+            os.makedirs(path, exist_ok=True)
+            continue
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        hasher = utils.new_hasher(algo)
+        with open(path, "wb") as f:
+            preallocate(f, entry["size"])
+
+            def write(data, position):
+                f.write(data)
+
+            if meter is not None:
+                write = meter.writer(write)
+            trailer = yield from receive_data(
+                sock,
+                write,
+                0,
+                entry["size"],
+                chunk,
+                hasher,
+                decompress,
+                write_behind=write_behind,
+            )
+        os.chmod(path, entry["mode"] & 0o777)
+        os.utime(path, (entry["mtime"], entry["mtime"]))
+        error = check_hash(hasher, trailer.get("hash") or entry.get("hash"))
+        if error is not None:
+            errors.append(f"{entry['path']}: {error}")
+        elif hasher is not None:
+            validated.append((path, hasher.hexdigest()))
+
+    if sync:
+        with file_index.FileIndex() as index:
+            for path, file_hash in validated:
+                index.update(path, algo, file_hash)
+    if errors:
+        error = " ".join(errors)
+        protocol.send_error(sock, f"File validation failed! {error}")
+        return error
+    protocol.send_json(sock, protocol.ACK, {"validated": algo != "none"})
+    return None
+
+
+def receive_tar(sock, save_dir, chunk, hasher, decompress=None, meter=None):
+    """
+    Unpack a tar stream into a directory while it is received, then read its TRAILER,
+    validate the stream and answer with an ACK or ERROR frame.
+    With a meter, the TransferMetrics of the transfer, disk writes are recorded.
+    Yields the number of file bytes unpacked since the previous yield.
+    Returns an error message if validation failed, otherwise None.
+    """
+    reader = protocol.DataReader(sock, hasher, decompress)
+    try:
+        with tarfile.open(fileobj=reader, mode="r|") as tar:
+            for member in tar:
+                path = utils.safe_join(save_dir, member.name)
+                if member.isdir():
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    continue  # links and special files are not transferred
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                source = tar.extractfile(member)
+                with open(path, "wb") as f, protocol.borrow_buffer(chunk) as buffer:
+                    if meter is not None:
+                        f = meter.file(f)
+                    view = memoryview(buffer)
+                    while True:
+                        n = source.readinto(view)
+                        if not n:
+                            break
+                        f.write(view[:n])
+                        yield n
+                os.chmod(path, member.mode & 0o777)
+                os.utime(path, (member.mtime, member.mtime))
+    except (ValueError, tarfile.TarError) as e:
+        raise protocol.ProtocolError(f"Invalid archive: {e}")
+
+    # read hash trailer
+    frame_type, size = reader.drain()
+    payload = protocol.recv_exact(sock, size)
+    trailer = protocol.decode_json(frame_type, payload, protocol.TRAILER)
+    return finish_receive(sock, hasher, trailer.get("hash"))
+
+
+def receive_chunks(
+    sock, write, chunks, missing, store, chunk, hasher, file_hash, decompress=None
+):
+    """
+    Rebuild a file from its list of chunks. Chunks missing from the store arrive as
+    DATA frames in the order they are first used, are checked against their hash and
+    added to the store, all others are read from it. Then read the TRAILER, validate
+    the file and answer with an ACK or ERROR frame.
+    Yields the number of bytes written since the previous yield.
+    Returns an error message if validation failed, otherwise None.
+    """
+    missing = set(missing)
+    position = 0
+    for digest, size in chunks:
+        if digest in missing:
+            frame_type, flags, length = protocol.recv_header(sock)
+            if frame_type != protocol.DATA:
+                raise protocol.ProtocolError(f"Expected chunk {digest}.")
+            pieces = protocol.iter_data(sock, flags, length, chunk, decompress)
+            data = b"".join(pieces)
+            if len(data) != size or dedup.chunk_hash(data) != digest:
+                raise protocol.ProtocolError(f"Chunk {digest} is corrupted.")
+            store.put(digest, data)
+            missing.discard(digest)
+        else:
+            data = store.get(digest)
+        if hasher is not None:
+            hasher.update(data)
+        write(data, position)
+        position += size
+        yield size
+
+    # read hash trailer
+    frame_type, _, size = protocol.recv_header(sock)
+    payload = protocol.recv_exact(sock, size)
+    trailer = protocol.decode_json(frame_type, payload, protocol.TRAILER)
+    return finish_receive(sock, hasher, trailer.get("hash") or file_hash)
+
+
+def finish_receive(sock, hasher, file_hash):
+    """
+    Validate received data against the sender's hash and answer with an ACK or ERROR
+    frame. Returns an error message if validation failed, otherwise None.
+    """
+    error = check_hash(hasher, file_hash)
+    if error is None:
+        protocol.send_json(sock, protocol.ACK, {"validated": hasher is not None})
+    else:
+        protocol.send_error(sock, f"File validation failed! {error}")
+    return error
+
+
+def check_hash(hasher, file_hash):
+    """
+    Returns an error message if the received data doesn't match the sender's hash.
+    Nothing is checked without a hasher.
+    """
+    if hasher is None:
+        return None
+    received_hash = hasher.hexdigest()
+    if received_hash == file_hash:
+        return None
+    return f"Expected {file_hash} but got {received_hash}."
+
+
+def receive_file_tcp(
+    port,
+    save_dir,
+    chunk,
+    verbose=False,
+    hash_algo="auto",
+    cache_size=dedup.DEFAULT_STORE_SIZE,
+    write_behind=pipeline.DEFAULT_DEPTH,
+    meter=None,
+):
+    chunk = tuning.chunk_bytes(chunk)  # convert to bytes
+    supported_algos = get_supported_hash_algos(hash_algo)
+    store = dedup.ChunkStore(max_size=cache_size)
     server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     if verbose:
         print("TCP server socket created.")
     server_sock.bind(("0.0.0.0", port))
-    server_sock.listen(1)
+    server_sock.listen()
     print(f"Listening for file on port {port}...")
 
     client_sock, address = server_sock.accept()
+
+    def join_streams(session, count):
+        return accept_streams(server_sock, session, count)
+
+    try:
+        yield from receive_transfer(
+            client_sock,
+            address,
+            save_dir,
+            chunk,
+            verbose,
+            supported_algos,
+            join_streams,
+            store=store,
+            write_behind=write_behind,
+            meter=meter,
+        )
+    finally:
+        server_sock.close()
+        if verbose:
+            print("TCP server socket closed.")
+
+
+def receive_transfer(
+    client_sock,
+    address,
+    save_dir,
+    chunk,
+    verbose,
+    supported_algos,
+    join_streams,
+    metadata=None,
+    store=None,
+    write_behind=0,
+    meter=None,
+):
+    """
+    Receive one transfer over an accepted connection. The extra connections of a
+    multi-stream session are gathered with `join_streams(session, count)`.
+    The metadata may have been read already, e.g. by a server routing connections.
+    Deduplicated transfers are rebuilt from the chunk `store`, without one they are
+    received as a whole.
+    With an "auto" chunk size the chunk and socket buffers are tuned to the link.
+    With `write_behind` data is written to disk on a separate thread, except when
+    resuming, where the checkpoints must not run ahead of the data on disk.
+    With a meter, a TransferMetrics, the phases of the transfer are timed and the
+    socket and disk calls recorded.
+    Yields progress dicts.
+    """
+    metered = meter is not None
+    meter = meter or metrics.TransferMetrics("receiver")
+    if metered:
+        client_sock = meter.socket(client_sock)
+    socks = [client_sock]
     print(f"Connection established with {address}.")
     if verbose:
         print("TCP client socket created.")
 
-    # get metadata
-    msg = "Waiting for metadata..."
-    if verbose:
-        print(msg, end="\r")
-    metadata = client_sock.recv(1024).decode()
-    if verbose:
-        print("Metadata received.".ljust(len(msg)))
-
+    checkpoint = None
+    pinned = None  # chunks of a deduplicated transfer kept in the store until it ends
     try:
-        msg = "decoding metadata..."
+        # get metadata
+        meter.enter("metadata")
+        msg = "Waiting for metadata..."
         if verbose:
             print(msg, end="\r")
-        metadata = json.loads(metadata)
+        if metadata is None:
+            metadata = protocol.recv_json(client_sock, protocol.METADATA)
         file_name = metadata["name"]
         file_size = metadata["size"]
         file_hash = metadata["hash"]
         is_dir = metadata["is_dir"]
+        archive = metadata.get("archive", "zip" if is_dir else None)
+        ranges = metadata.get("ranges", [[0, file_size]])
+        file_path = utils.safe_join(save_dir, file_name)
         if verbose:
-            print("Metadata decoded.".ljust(len(msg)))
+            print("Metadata received.".ljust(len(msg)))
+
+        # the sender measured the round trip time while connecting
+        tuner = None
+        if chunk == tuning.AUTO:
+            chunk = tuning.START_CHUNK
+            tuning.set_nodelay(client_sock)
+            rtt = metadata.get("rtt")
+            tuner = tuning.LinkTuner(socks, rtt, socket.SO_RCVBUF, verbose)
+            if verbose:
+                print(f"Chunk size: auto, starting at {chunk // 1024} kb.")
+
+        # negotiate hash algorithm
+        algo = resolve_hash_algo(metadata, supported_algos)
+        if algo is None:
+            error = f"Hash algorithm {metadata['hash_algo']} is not supported."
+            protocol.send_error(client_sock, error, hash_algos=supported_algos)
+            print(f"Rejected transfer: {error}")
+            client_sock.close()
+            print("TCP Socket closed.")
+            return
+        if verbose:
+            print(f"Hash algorithm: {algo}")
+
+        # negotiate compression codec
+        codec = resolve_codec(metadata)
+        if codec is None:
+            error = f"Compression codec {metadata['compress']} is not supported."
+            codecs = compression.available_codecs()
+            protocol.send_error(client_sock, error, codecs=codecs)
+            print(f"Rejected transfer: {error}")
+            client_sock.close()
+            print("TCP Socket closed.")
+            return
+        if verbose:
+            print(f"Compression: {codec}")
+        decompressors = [compression.new_decompressor(codec) for _ in ranges]
+
+        # hash the data as it arrives instead of rereading the saved file
+        hashers = [utils.new_hasher(algo) for _ in ranges]
+
+        # look for a partial file left by an interrupted transfer
+        offset = 0
+        resume = metadata.get("resume", False) and len(ranges) == 1
+        if resume:
+            offset, hashers[0] = find_resume_offset(file_path, metadata, algo)
+            ranges = [[offset, file_size - offset]]
+            if offset:
+                print(
+                    "Resuming from {} {}.".format(*utils.convert_byte(offset, "auto"))
+                )
+
+        # offer the block signatures of an existing copy for a delta transfer
+        signatures = None
+        if (
+            metadata.get("delta")
+            and len(ranges) == 1
+            and not resume
+            and archive is None
+            and os.path.isfile(file_path)
+        ):
+            block = delta.block_size(os.path.getsize(file_path))
+            signatures = {
+                "block": block,
+                "signatures": delta.build_signatures(file_path, block),
+            }
+            if verbose:
+                print(f"Sending signatures of {len(signatures['signatures'])} blocks.")
+
+        # list the chunks of a deduplicated transfer that are not in the store yet
+        missing = None
+        if (
+            metadata.get("dedup")
+            and store is not None
+            and len(ranges) == 1
+            and not resume
+            and archive is None
+        ):
+            # pinned before the lookup, so no other transfer evicts them in between
+            pinned = list(dict.fromkeys(digest for digest, _ in metadata["chunks"]))
+            store.pin(pinned)
+            missing = [digest for digest in pinned if not store.has(digest)]
+            if verbose:
+                count = len(metadata["chunks"])
+                print(f"Missing {len(missing)} of {count} chunks.")
+
+        # leave out the files of a sync transfer that are already up to date
+        manifest = metadata.get("manifest")
+        unchanged = None
+        if metadata.get("sync") and archive == "manifest":
+            unchanged = file_index.find_unchanged(save_dir, manifest, algo)
+            skipped = set(unchanged)
+            manifest = [
+                entry
+                for position, entry in enumerate(manifest)
+                if position not in skipped
+            ]
+            file_size = sum(entry["size"] for entry in manifest)
+            print(f"{len(unchanged)} files are up to date.")
 
         # send acknowledgment
         msg = "Sending acknowledgment..."
         if verbose:
             print(msg, end="\r")
-        client_sock.sendall(b"ACK")
+        ack = {
+            "hash_algo": algo,
+            "hash_algos": supported_algos,
+            "offset": offset,
+            "compress": codec,
+            "delta": signatures,
+            "dedup": missing,
+            "sync": unchanged,
+        }
+        protocol.send_json(client_sock, protocol.ACK, ack)
         if verbose:
             print("Acknowledgment sent.".ljust(len(msg)))
     except Exception as e:
-        print(f"Failed to decode metadata: {e}")
-        print(f"metadata: {metadata}")
-        server_sock.close()
+        print(f"Failed to receive metadata: {e}")
+        if isinstance(metadata, dict):
+            # not the whole metadata, manifests and chunk lists can be huge
+            name, size = metadata.get("name"), metadata.get("size")
+            print(f"metadata: name {name}, size {size}")
+        if pinned is not None:
+            store.unpin(pinned)
         client_sock.close()
         print("TCP Socket closed.")
         return
 
     # receive file
     try:
+        # gather the extra connections of a multi-stream session
+        if len(ranges) > 1:
+            if verbose:
+                print(f"Waiting for {len(ranges) - 1} more streams...")
+            streams = join_streams(metadata["session"], len(ranges) - 1)
+            if metered:
+                streams = [meter.socket(s) for s in streams]
+            socks += streams
+
         # create directory if it doesn't exist
         os.makedirs(save_dir, exist_ok=True)
 
+        meter.enter("data")
         start_time = time.time()
-        with open(os.path.join(save_dir, file_name), "wb") as f:
+        results = []
+        received = 0
+        if archive in ("tar", "manifest"):
+            # unpack while receiving, nothing is staged on disk
             if verbose:
-                print(f"Receiving file from {address}...")
-            while True:
-                data = client_sock.recv(chunk)
-                if not data:
-                    break
-                f.write(data)
+                print(f"Receiving directory from {address}...")
+            if archive == "tar":
+                jobs = [
+                    receive_tar(
+                        client_sock,
+                        save_dir,
+                        chunk,
+                        hashers[0],
+                        decompressors[0],
+                        meter if metered else None,
+                    )
+                ]
+            else:
+                jobs = [
+                    receive_manifest(
+                        client_sock,
+                        save_dir,
+                        manifest,
+                        chunk,
+                        algo,
+                        decompressors[0],
+                        unchanged is not None,
+                        write_behind,
+                        meter if metered else None,
+                    )
+                ]
+            yield from progress.throttle(run_streams(jobs, results), file_size)
+        else:
+            # a delta transfer rebuilds the file next to the copy it reads blocks from
+            target = file_path + DELTA_SUFFIX if signatures else file_path
+            basis = None
+            if signatures:
+                basis = read_blocks(file_path, signatures["block"])
+            with open(target, "r+b" if offset else "wb") as f:
+                if verbose:
+                    print(f"Receiving file from {address}...")
+                if not resume:
+                    preallocate(f, file_size)
+                if len(ranges) > 1:
+                    # every stream writes its byte range at its own offset
+                    lock = threading.Lock()
 
-                # print progress
-                yield {"current": f.tell(), "total": file_size}
+                    def write(data, position):
+                        write_at(f, data, position, lock)
 
-                # check if file is complete
-                if f.tell() == file_size:
-                    break
+                elif resume:
+                    # keep the sidecar state current so a dropped connection can resume
+                    f.truncate(offset)
+                    f.seek(offset)
+                    checkpoint = {
+                        "received": offset,
+                        "next": offset + CHECKPOINT_INTERVAL,
+                    }
+                    write_partial_state(file_path, metadata, algo, offset, hashers[0])
+
+                    def write(data, position):
+                        f.write(data)
+                        checkpoint["received"] = position + len(data)
+                        if checkpoint["received"] >= checkpoint["next"]:
+                            f.flush()
+                            write_partial_state(
+                                file_path,
+                                metadata,
+                                algo,
+                                checkpoint["received"],
+                                hashers[0],
+                            )
+                            checkpoint["next"] += CHECKPOINT_INTERVAL
+
+                else:
+
+                    def write(data, position):
+                        f.write(data)
+
+                if metered:
+                    write = meter.writer(write)
+                if missing is not None:
+                    jobs = [
+                        receive_chunks(
+                            client_sock,
+                            write,
+                            metadata["chunks"],
+                            missing,
+                            store,
+                            chunk,
+                            hashers[0],
+                            file_hash,
+                            decompressors[0],
+                        )
+                    ]
+                else:
+                    behind = 0 if resume else write_behind
+                    jobs = [
+                        receive_range(
+                            s, write, o, n, chunk, h, file_hash, d, basis, tuner, behind
+                        )
+                        for s, (o, n), h, d in zip(
+                            socks, ranges, hashers, decompressors
+                        )
+                    ]
+                reporter = progress.ProgressReporter(file_size, offset)
+                for received in run_streams(jobs, results):
+                    report = reporter.update(offset + received)
+                    if report is not None:
+                        yield report
         end_time = time.time()
         print(f"\ncomplete in {round(end_time - start_time, 2)} seconds. [{file_name}]")
 
+        meter.enter("validate")
         msg = "Validating file..."
         print(msg, end="\r")
-        if utils.validate_hash(os.path.join(save_dir, file_name), file_hash):
+        errors = [error for error in results if error is not None]
+        if len(ranges) > 1:
+            errors = [
+                f"Bytes {o}-{o + n}: {error}"
+                for (o, n), error in zip(ranges, results)
+                if error is not None
+            ]
+        if algo == "none":
+            print("Validation skipped.".ljust(len(msg)))
+        elif not errors:
             print("File validated.".ljust(len(msg)))
         else:
-            print(
-                f"File validation failed! Expected {file_hash} but got {utils.get_hash(os.path.join(save_dir, file_name))}."
-            )
+            print(f"File validation failed! {' '.join(errors)}")
+        if resume:
+            remove_partial_state(file_path)
+        if signatures:
+            if errors:
+                os.remove(target)
+            else:
+                os.replace(target, file_path)
 
         # Unpack zip file if it is a directory
-        if is_dir:
+        if archive == "zip":
+            meter.enter("unzip")
             msg = "Data is a directory. Unzipping..."
             print(msg, end="\r")
-            utils.unzip_dir(os.path.join(save_dir, file_name), save_dir)
+            utils.unzip_dir(file_path, save_dir)
             print("Unzipped.".ljust(len(msg)))
-            os.remove(os.path.join(save_dir, file_name))
+            os.remove(file_path)
 
-    except socket.error as e:
+    except (socket.error, protocol.ProtocolError) as e:
         print(f"File transfer failed: {e}")
+        if isinstance(e, protocol.ProtocolError):
+            # tell the sender why, it may still be sending
+            try:
+                protocol.send_error(client_sock, f"File transfer failed: {e}")
+            except OSError:
+                pass
+        if signatures and os.path.exists(file_path + DELTA_SUFFIX):
+            os.remove(file_path + DELTA_SUFFIX)
+        elif (
+            archive in (None, "zip")
+            and len(ranges) == 1
+            and not resume
+            and os.path.exists(file_path)
+        ):
+            # drop the preallocated space the data never reached
+            os.truncate(file_path, received)
+        if checkpoint is not None:
+            write_partial_state(
+                file_path, metadata, algo, checkpoint["received"], hashers[0]
+            )
+            print("Partial file kept. Send again with --resume to continue.")
         return
     finally:
-        client_sock.close()
+        if pinned is not None:
+            store.unpin(pinned)
+        meter.finish()
+        close_sockets(socks)
         if verbose:
             print("TCP client socket closed.")
+
+
+def serve_files_tcp(
+    port,
+    save_dir,
+    chunk,
+    verbose=False,
+    hash_algo="auto",
+    workers=SERVE_WORKERS,
+    stop=None,
+    cache_size=dedup.DEFAULT_STORE_SIZE,
+    write_behind=pipeline.DEFAULT_DEPTH,
+):
+    """
+    Receive files from many senders at once until `stop` is set or the generator is
+    closed. One listening socket is kept for the whole lifetime of the server, and
+    every transfer runs on a bounded pool of `workers` threads.
+    The extra connections of multi-stream sessions are routed to their transfer by
+    the session id, so they never wait for a free worker.
+    Yields progress dicts carrying the session id and name of their transfer, and
+    a final one with "done" set when a transfer ends.
+    """
+    chunk = tuning.chunk_bytes(chunk)  # convert to bytes
+    supported_algos = get_supported_hash_algos(hash_algo)
+    store = dedup.ChunkStore(max_size=cache_size)
+    stop = stop or threading.Event()
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if verbose:
+        print("TCP server socket created.")
+    server_sock.bind(("0.0.0.0", port))
+    server_sock.listen()
+    server_sock.settimeout(ACCEPT_INTERVAL)
+    print(f"Serving files on port {port} with {workers} workers...")
+
+    events = queue.Queue()
+    sessions = {}  # session id -> joined stream sockets by index
+    joined = threading.Condition()
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def join_streams(session, count):
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        with joined:
+            while len(sessions[session]) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise protocol.ProtocolError(
+                        "Timed out waiting for transfer streams."
+                    )
+                joined.wait(remaining)
+            streams = sessions[session]
+            sessions[session] = {}
+        return [streams[index] for index in range(1, count + 1)]
+
+    def transfer(sock, address, metadata, session):
+        name = metadata.get("name")
+        try:
+            for report in receive_transfer(
+                sock,
+                address,
+                save_dir,
+                chunk,
+                verbose,
+                supported_algos,
+                join_streams,
+                metadata,
+                store,
+                write_behind,
+            ):
+                events.put({"session": session, "name": name, **report})
+        except Exception as e:
+            print(f"File transfer failed: {e}")
+        finally:
+            with joined:
+                close_sockets(sessions.pop(session).values())
+            events.put({"session": session, "name": name, "done": True})
+
+    def handshake(sock, address):
+        # the first frame tells a new transfer from a stream joining one
+        try:
+            sock.settimeout(JOIN_TIMEOUT)
+            metadata = protocol.recv_json(sock, protocol.METADATA)
+            sock.settimeout(None)
+        except (OSError, ValueError, MemoryError, protocol.ProtocolError) as e:
+            print(f"Failed to receive metadata from {address}: {e}")
+            sock.close()
+            return
+        if "stream" not in metadata:
+            session = metadata.get("session") or uuid.uuid4().hex
+            with joined:
+                sessions.setdefault(session, {})
+            pool.submit(transfer, sock, address, metadata, session)
+            return
+
+        # wait for the transfer the stream belongs to, its metadata may come later
+        session = metadata.get("session")
+        deadline = time.monotonic() + JOIN_TIMEOUT
+        with joined:
+            while session not in sessions and time.monotonic() < deadline:
+                joined.wait(ACCEPT_INTERVAL)
+            if session in sessions:
+                sessions[session][metadata["stream"]] = sock
+                joined.notify_all()
+                return
+        try:
+            protocol.send_error(sock, "Unknown transfer session.")
+        except OSError:
+            pass
+        sock.close()
+
+    def accept_loop():
+        while not stop.is_set():
+            try:
+                sock, address = server_sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            threading.Thread(
+                target=handshake, args=(sock, address), daemon=True
+            ).start()
+
+    acceptor = threading.Thread(target=accept_loop, daemon=True)
+    acceptor.start()
+    try:
+        while not stop.is_set():
+            try:
+                yield events.get(timeout=ACCEPT_INTERVAL)
+            except queue.Empty:
+                continue
+    finally:
+        stop.set()
+        acceptor.join()
         server_sock.close()
+        pool.shutdown(wait=False, cancel_futures=True)
         if verbose:
             print("TCP server socket closed.")
@@ -0,0 +1,97 @@
+import math
+import socket
+import sys
+import threading
+
+AUTO = "auto"
+START_CHUNK = 1024 * 64  # bytes per send/recv until the link is measured
+MIN_CHUNK = 1024 * 64
+MAX_CHUNK = 1024 * 1024 * 4
+CHUNK_INTERVAL = 0.002  # seconds of data moved per send/recv at the measured rate
+PROBE_BYTES = 1024 * 1024 * 8  # bytes sent before the throughput is measured
+MIN_SOCKET_BUFFER = 1024 * 256
+MAX_SOCKET_BUFFER = 1024 * 1024 * 16
+DEFAULT_RTT = 0.001  # seconds, assumed when the peer didn't measure one
+
+# Linux grows socket buffers on its own up to net.ipv4.tcp_rmem/tcp_wmem, and
+# setting SO_SNDBUF/SO_RCVBUF switches that off, capped at net.core.*mem_max.
+KERNEL_AUTOTUNING = sys.platform.startswith("linux")
+
+
+def chunk_bytes(chunk):
+    """
+    Convert a chunk size given in kb to bytes, leaving "auto" as it is.
+    """
+    return chunk if chunk == AUTO else chunk * 1024
+
+
+def set_nodelay(sock):
+    """
+    Send small frames such as METADATA and ACK right away instead of waiting for
+    more data to coalesce with them.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
+
+
+def clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class LinkTuner:
+    """
+    Chunk and socket buffer sizes of an auto mode transfer. Data starts out with
+    START_CHUNK. Once the first PROBE_BYTES are through, their throughput and the
+    round trip time of the handshake give the bandwidth-delay product of the link,
+    which sizes the chunk and the socket buffers for the rest of the transfer.
+    One tuner can be shared by all streams of a transfer, the first stream to
+    finish its probe tunes all of them.
+    """
+
+    def __init__(self, socks, rtt, option, verbose=False):
+        self.socks = socks
+        self.rtt = rtt or DEFAULT_RTT
+        self.option = option  # SO_SNDBUF on the sender, SO_RCVBUF on the receiver
+        self.verbose = verbose
+        self.chunk = START_CHUNK
+        self.buffer = None
+        self.tuned = False
+        self.lock = threading.Lock()
+
+    def tune(self, size, seconds):
+        """
+        Size chunk and socket buffers from `size` bytes moved in `seconds`.
+        Returns the chunk size to use from now on.
+        """
+        with self.lock:
+            if self.tuned:
+                return self.chunk
+            self.tuned = True
+            throughput = size / max(seconds, 1e-6)
+            bdp = throughput * self.rtt
+            # a chunk keeps the pipe full on its own and is big enough that
+            # per-call overhead doesn't matter at this rate
+            chunk = max(bdp, throughput * CHUNK_INTERVAL)
+            chunk = 2 ** math.ceil(math.log2(max(chunk, 1)))
+            self.chunk = clamp(chunk, MIN_CHUNK, MAX_CHUNK)
+            if not KERNEL_AUTOTUNING:
+                self.buffer = int(clamp(2 * bdp, MIN_SOCKET_BUFFER, MAX_SOCKET_BUFFER))
+                for sock in self.socks:
+                    try:
+                        sock.setsockopt(socket.SOL_SOCKET, self.option, self.buffer)
+                    except OSError:
+                        pass
+            if self.verbose:
+                self.print_choice(throughput)
+            return self.chunk
+
+    def print_choice(self, throughput):
+        rate = throughput / (1024 * 1024)
+        print(f"\nLink: RTT {self.rtt * 1000:.2f} ms, {rate:.1f} mb/s.")
+        if self.buffer is None:
+            buffers = "tuned by the kernel"
+        else:
+            buffers = f"{self.buffer // 1024} kb"
+        print(f"Chunk size: {self.chunk // 1024} kb, socket buffers: {buffers}.")
@@ -2,10 +2,26 @@ import hashlib
 import json
 import os
 import socket
+import tarfile
 import zipfile
 
 from . import progress_bar as pb
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+HASH_CHUNK_SIZE = 1024 * 1024  # bytes read per step when hashing a file
+HASH_ALGOS = ["xxh3", "blake3", "blake2b", "md5"]  # ordered fastest first
+HASH_CHOICES = ["auto", *HASH_ALGOS, "none"]
+DEFAULT_HASH_ALGO = "blake2b"  # always available through hashlib
+
 
 def read_manifest():
     dir_path = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -73,7 +89,12 @@ def get_local_ip():
     return ip
 
 
-def zip_dir(dir_path, zip_path, chunk_size=1024 * 1024 * 20):
+def zip_dir(dir_path, zip_path, chunk_size=1024 * 1024 * 20, stored=False):
+    """
+    Zip a directory. With `stored` the files are not compressed, e.g. when the
+    transfer stream compresses them anyway.
+    """
+    compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
     total_size = sum(
         [
             os.path.getsize(os.path.join(root, file))
@@ -83,7 +104,7 @@ def zip_dir(dir_path, zip_path, chunk_size=1024 * 1024 * 20):
     )
     processed_size = 0
 
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zipf:
+    with zipfile.ZipFile(zip_path, "w", compress_type) as zipf:
         for root, dirs, files in os.walk(dir_path):
             for file in files:
                 file_path = os.path.join(root, file)
@@ -91,7 +112,7 @@ def zip_dir(dir_path, zip_path, chunk_size=1024 * 1024 * 20):
 
                 # Create a ZipInfo object for the file
                 zip_info = zipfile.ZipInfo(rel_path)
-                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                zip_info.compress_type = compress_type
                 zip_info.file_size = os.path.getsize(file_path)
 
                 # Open the file and read in chunks
@@ -120,6 +141,130 @@ def unzip_dir(zip_path, dir_path):
         zipf.extractall(dir_path)
 
 
+def get_dir_size(dir_path):
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(dir_path)
+        for file in files
+    )
+
+
+def build_manifest(dir_path):
+    """
+    List the directories and files of a tree with their sizes, modification times and
+    permissions. Paths are relative to the parent of `dir_path` and use "/".
+    A file on its own gives a manifest with a single entry.
+    """
+    parent = os.path.join(dir_path, "..")
+    if os.path.isdir(dir_path):
+        walk = os.walk(dir_path)
+    else:
+        walk = [(os.path.dirname(dir_path), None, [os.path.basename(dir_path)])]
+    manifest = []
+    for root, dirs, files in walk:
+        paths = [(os.path.join(root, file), "file") for file in files]
+        if dirs is not None:
+            paths.insert(0, (root, "dir"))
+        for path, kind in paths:
+            st = os.stat(path)
+            manifest.append(
+                {
+                    "path": os.path.relpath(path, parent).replace(os.sep, "/"),
+                    "type": kind,
+                    "size": st.st_size if kind == "file" else 0,
+                    "mtime": st.st_mtime,
+                    "mode": st.st_mode & 0o777,
+                }
+            )
+    return manifest
+
+
+def build_batch_manifest(paths):
+    """
+    Manifest of several files and directories sent together, each placed at the top
+    of the receiver's save directory.
+    Returns a tuple of (manifest, sources) where sources holds the local path of
+    every entry.
+    """
+    manifest = []
+    sources = []
+    names = set()
+    for path in paths:
+        path = os.path.normpath(path)
+        name = os.path.basename(path)
+        if name in names:
+            raise ValueError(f"More than one path is named {name}.")
+        names.add(name)
+        parent = os.path.dirname(path)
+        for entry in build_manifest(path):
+            manifest.append(entry)
+            sources.append(os.path.join(parent, *entry["path"].split("/")))
+    return manifest, sources
+
+
+def safe_join(root, name):
+    """
+    Join a path received from a peer onto a local root, refusing paths that escape it.
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Refusing to write outside of {root}: {name}")
+    return path
+
+
+def iter_tar_dir(dir_path, chunk_size):
+    """
+    Generate a tar archive of a directory on the fly, without staging it on disk.
+    Yields tuples of (data, processed) where data is at most `chunk_size` bytes and
+    processed is the number of file bytes packed so far, so progress can be reported
+    against the uncompressed size.
+    """
+    parent = os.path.join(dir_path, "..")
+    buffer = bytearray()
+    processed = 0
+
+    def add_header(path, arcname, kind, size):
+        st = os.stat(path)
+        info = tarfile.TarInfo(arcname.replace(os.sep, "/"))
+        info.type = kind
+        info.size = size
+        info.mode = st.st_mode & 0o7777
+        info.mtime = st.st_mtime
+        buffer.extend(info.tobuf(format=tarfile.PAX_FORMAT))
+
+    for root, dirs, files in os.walk(dir_path):
+        add_header(root, os.path.relpath(root, parent), tarfile.DIRTYPE, 0)
+        for file in files:
+            file_path = os.path.join(root, file)
+            size = os.path.getsize(file_path)
+            add_header(
+                file_path, os.path.relpath(file_path, parent), tarfile.REGTYPE, size
+            )
+
+            # copy the file content, padded to the tar block size
+            remaining = size
+            with open(file_path, "rb") as f:
+                while remaining > 0:
+                    data = f.read(min(chunk_size, remaining))
+                    if not data:
+                        # file shrank while packing, keep the declared size
+                        data = bytes(min(chunk_size, remaining))
+                    buffer.extend(data)
+                    remaining -= len(data)
+                    processed += len(data)
+                    while len(buffer) >= chunk_size:
+                        yield bytes(buffer[:chunk_size]), processed
+                        del buffer[:chunk_size]
+            buffer.extend(bytes(-size % tarfile.BLOCKSIZE))
+
+    # end of archive marker
+    buffer.extend(bytes(tarfile.BLOCKSIZE * 2))
+    while buffer:
+        yield bytes(buffer[:chunk_size]), processed
+        del buffer[:chunk_size]
+
+
 def handshake_send(sock, ip, port, timeout: float | int = 5):
     """
     Perform a handshake between sender and receiver.
@@ -151,23 +296,114 @@ def handshake_receive(sock):
         return False
 
 
-def validate_hash(path, hash_value):
-    return get_hash(path) == hash_value
+def available_hash_algos():
+    """
+    List the hash algorithms usable on this machine, fastest first.
+    """
+    algos = []
+    for algo in HASH_ALGOS:
+        if algo == "xxh3" and xxhash is None:
+            continue
+        if algo == "blake3" and blake3 is None:
+            continue
+        algos.append(algo)
+    return algos
 
 
-def get_hash(path):
-    with open(path, "rb") as f:
-        data = f.read()
-        return hashlib.md5(data).hexdigest()
+def negotiate_hash_algo(offered, supported):
+    """
+    Pick the first offered hash algorithm that is also supported.
+    Returns None if there is no common algorithm.
+    """
+    for algo in offered:
+        if algo in supported:
+            return algo
+    return None
+
+
+def new_hasher(algo=DEFAULT_HASH_ALGO):
+    """
+    Create an incremental hasher, used to hash data inline while it is streamed.
+    Returns None for the "none" algorithm.
+    """
+    if algo == "none":
+        return None
+    if algo not in available_hash_algos():
+        raise ValueError(f"Unsupported hash algorithm {algo}")
+    if algo == "xxh3":
+        return xxhash.xxh3_128()
+    if algo == "blake3":
+        return blake3.blake3()
+    return hashlib.new(algo)
+
+
+def get_hash(
+    path, algo=DEFAULT_HASH_ALGO, chunk_size=HASH_CHUNK_SIZE, offset=0, length=None
+):
+    """
+    Hash a file in bounded chunks so memory usage doesn't grow with the file size.
+    `offset` and `length` limit the hash to a byte range of the file.
+    Returns None for the "none" algorithm.
+    """
+    hasher = new_hasher(algo)
+    if hasher is None:
+        return None
+    update_hash(hasher, path, chunk_size, offset, length)
+    return hasher.hexdigest()
 
 
-def print_progress(iteration, total, title="progress", verbose=False, unit="auto"):
+def update_hash(hasher, path, chunk_size=HASH_CHUNK_SIZE, offset=0, length=None):
+    """
+    Feed a byte range of a file into an existing hasher.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        remaining = length
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            data = f.read(size)
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher
+
+
+def print_progress(
+    iteration,
+    total,
+    title="progress",
+    verbose=False,
+    unit="auto",
+    speed=None,
+    eta=None,
+):
     sent_data = convert_byte(iteration, unit)
     total_data = convert_byte(total, unit)
     description = f"({total_data[0]} {total_data[1]})"
     if verbose:
         description = f"({sent_data[0]} {sent_data[1]}/{total_data[0]} {total_data[1]})"
-    pb.progress_bar(iteration, total, title=title, description=description)
+    if speed is not None:
+        rate = convert_byte(speed, unit)
+        description += f" {rate[0]} {rate[1]}/s"
+    if eta is not None:
+        description += f" ETA {format_seconds(eta)}"
+    if not total:
+        iteration = total = 1  # a transfer without data is complete from the start
+    # pad over the end of a longer previous line
+    pb.progress_bar(iteration, total, title=title, description=description.ljust(40))
+
+
+def format_seconds(seconds):
+    """
+    Format a duration as h:mm:ss, or m:ss below an hour.
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02}:{seconds:02}"
+    return f"{minutes}:{seconds:02}"
 
 
 def convert_byte(byte, unit, percision: int = 2):
@@ -1,6 +1,11 @@
+import threading
+import time
+
 from PySide6.QtCore import QThread, Signal
 
-from nx.core.tcp_transfer import receive_file_tcp
+from nx.core.tcp_transfer import serve_files_tcp
+
+EMIT_INTERVAL = 1 / 30  # seconds between progress signals, so the GUI keeps up
 
 
 class FileReceiverThread(QThread):
@@ -19,20 +24,34 @@ class FileReceiverThread(QThread):
         self.port = port
         self.file_dir = file_dir
         self.chunk_size = chunk_size
+        self.stop = threading.Event()
 
     def run(self):
-        while not self.isInterruptionRequested():
-            try:
-                for progress in receive_file_tcp(
-                    int(self.port), self.file_dir, self.chunk_size
+        # one server keeps the port open and receives from several senders at once
+        try:
+            last_emit = 0
+            for progress in serve_files_tcp(
+                int(self.port), self.file_dir, self.chunk_size, stop=self.stop
+            ):
+                if self.isInterruptionRequested():
+                    break
+                if progress.get("done"):
+                    self.finished_receiving.emit()
+                    continue
+                # concurrent transfers report at once, skip updates until the
+                # interval has passed, but never the last one of a transfer
+                now = time.monotonic()
+                if (
+                    now - last_emit >= EMIT_INTERVAL
+                    or progress["current"] >= progress["total"]
                 ):
-                    if self.isInterruptionRequested():
-                        break
+                    last_emit = now
                     self.update_progress.emit(progress)
-                self.finished_receiving.emit()
-                self.sleep(1)  # prevent the thread from running too fast
-            except Exception as e:
-                self.error_occured.emit(str(e))
-                print(f"Error during file receiving: {e}")
-                break
+        except Exception as e:
+            self.error_occured.emit(str(e))
+            print(f"Error during file receiving: {e}")
         self.finished_thread.emit()  # emit the signal when the thread is done
+
+    def requestInterruption(self):
+        super().requestInterruption()
+        self.stop.set()
@@ -1,7 +1,11 @@
+import time
+
 from PySide6.QtCore import QThread, Signal
 
 from nx.core.tcp_transfer import send_file_tcp
 
+EMIT_INTERVAL = 1 / 30  # seconds between progress signals, so the GUI keeps up
+
 
 class FileSenderThread(QThread):
     update_progress = Signal(dict)
@@ -18,10 +22,18 @@ class FileSenderThread(QThread):
 
     def run(self):
         try:
+            last_emit = 0
             for progress in send_file_tcp(
                 self.ip, int(self.port), self.file_path, self.chunk_size, self.zip_mode
             ):
-                self.update_progress.emit(progress)
+                # skip updates until the interval has passed, but never the last one
+                now = time.monotonic()
+                if (
+                    now - last_emit >= EMIT_INTERVAL
+                    or progress["current"] >= progress["total"]
+                ):
+                    last_emit = now
+                    self.update_progress.emit(progress)
             self.finished_sending.emit()
         except Exception as e:
             self.error_occured.emit(str(e))
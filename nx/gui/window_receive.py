@@ -75,6 +75,12 @@ class ReceiveWindow(QWidget):
         self.progress_bar.setValue(0)
         main_layout.addWidget(self.progress_bar, 4, 0, 1, 2)
 
+        # speed and ETA labels
+        self.speed_label = QLabel()
+        main_layout.addWidget(self.speed_label, 5, 0)
+        self.eta_label = QLabel()
+        main_layout.addWidget(self.eta_label, 5, 1)
+
         # Set the layout
         self.setLayout(main_layout)
 
@@ -93,7 +99,7 @@ class ReceiveWindow(QWidget):
                 return
 
             # Create and start the file receiver thread
-            self.file_receiver_thread = FileReceiverThread(port, file_dir, 4)
+            self.file_receiver_thread = FileReceiverThread(port, file_dir, "auto")
             self.file_receiver_thread.update_progress.connect(self.update_progress_bar)
             self.file_receiver_thread.finished_receiving.connect(
                 self.on_receiving_finished
@@ -110,6 +116,8 @@ class ReceiveWindow(QWidget):
 
     def close_toggle_switch(self):
         self.progress_bar.setValue(0)
+        self.speed_label.clear()
+        self.eta_label.clear()
         self.toggle_switch.setChecked(False)
 
     def closeEvent(self, event):
@@ -130,12 +138,20 @@ class ReceiveWindow(QWidget):
     def update_progress_bar(self, progress):
         current = progress["current"]
         total = progress["total"]
-        percent = int((current / total) * 100)
+        # a transfer without data is complete from the start
+        percent = int((current / total) * 100) if total else 100
         self.progress_bar.setValue(percent)
+        if progress.get("speed") is not None:
+            speed = utils.convert_byte(progress["speed"], "auto")
+            self.speed_label.setText(f"{speed[0]} {speed[1]}/s")
+        if progress.get("eta") is not None:
+            self.eta_label.setText(f"ETA {utils.format_seconds(progress['eta'])}")
 
     @Slot()
     def on_receiving_finished(self):
         self.progress_bar.setValue(0)
+        self.speed_label.clear()
+        self.eta_label.clear()
 
     def browse_save_path(self):
         file_path = QFileDialog.getExistingDirectory(
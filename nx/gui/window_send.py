@@ -6,6 +6,7 @@ from PySide6.QtGui import QIcon
 from PySide6.QtWidgets import (
     QComboBox,
     QGridLayout,
+    QLabel,
     QMessageBox,
     QProgressBar,
     QPushButton,
@@ -71,6 +72,12 @@ class SendWindow(QWidget):
         self.progress_bar.setValue(0)
         main_layout.addWidget(self.progress_bar, 5, 0, 1, 2)
 
+        # create speed and ETA labels
+        self.speed_label = QLabel()
+        main_layout.addWidget(self.speed_label, 6, 0)
+        self.eta_label = QLabel()
+        main_layout.addWidget(self.eta_label, 6, 1)
+
         # Set the layout
         self.setLayout(main_layout)
         self.setWindowTitle("Sender")
@@ -91,7 +98,9 @@ class SendWindow(QWidget):
             is_dir = os.path.isdir(file_path)
 
             # Create and start the file sender thread
-            self.file_sender_thread = FileSenderThread(ip, port, file_path, 4, is_dir)
+            self.file_sender_thread = FileSenderThread(
+                ip, port, file_path, "auto", is_dir
+            )
             self.file_sender_thread.update_progress.connect(self.update_progress_bar)
             self.file_sender_thread.finished_sending.connect(self.on_sending_finished)
             self.file_sender_thread.error_occured.connect(self.on_error_occured)
@@ -107,17 +116,26 @@ class SendWindow(QWidget):
     def update_progress_bar(self, progress):
         current = progress["current"]
         total = progress["total"]
-        percent = int((current / total) * 100)
+        # a transfer without data is complete from the start
+        percent = int((current / total) * 100) if total else 100
         self.progress_bar.setValue(percent)
+        if progress.get("speed") is not None:
+            speed = utils.convert_byte(progress["speed"], "auto")
+            self.speed_label.setText(f"{speed[0]} {speed[1]}/s")
+        if progress.get("eta") is not None:
+            self.eta_label.setText(f"ETA {utils.format_seconds(progress['eta'])}")
 
     @Slot()
     def on_sending_finished(self):
         print("done sending")
         self.progress_bar.setValue(100)
+        self.eta_label.clear()
 
     def clear(self):
         self.drop_area.clear()
         self.progress_bar.setValue(0)
+        self.speed_label.clear()
+        self.eta_label.clear()
 
     def refresh_ip_combo_boxes(self):
         self.combo_box_ip.clear()
@@ -24,6 +24,11 @@ setup(
     install_requires=[
         "PySide6",
     ],
+    extras_require={
+        "fast-hash": ["xxhash", "blake3"],
+        "compress": ["zstandard", "lz4"],
+        "profile": ["pyinstrument"],
+    },
     entry_points={
         "console_scripts": [
             "nx = nx.cli.cli_main:main",
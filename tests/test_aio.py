@@ -0,0 +1,139 @@
+import asyncio
+import os
+
+import pytest
+
+from nx.core import aio, protocol
+from nx.core.bench import free_port
+
+
+async def receive(port, save_dir, send):
+    """
+    Run a receiver on `port` and the `send` coroutine against it.
+    Returns a tuple of (sender result, receiver result).
+    """
+    receiver = asyncio.create_task(aio.receive_file(port, save_dir))
+    await asyncio.sleep(0.1)  # let the server start listening
+    try:
+        result = await send
+    finally:
+        error = await receiver
+    return result, error
+
+
+def test_send_file(tmp_path):
+    source = tmp_path / "data.bin"
+    source.write_bytes(os.urandom(1024 * 300))
+    port = free_port()
+    for zero_copy, inline_hash in [(True, False), (False, True)]:
+        send = aio.send_file(
+            "127.0.0.1",
+            port,
+            str(source),
+            zero_copy=zero_copy,
+            inline_hash=inline_hash,
+        )
+        result, error = asyncio.run(receive(port, str(tmp_path / "out"), send))
+        assert error is None
+        assert result["validated"]
+        assert (tmp_path / "out" / "data.bin").read_bytes() == source.read_bytes()
+
+
+def test_send_directory(tmp_path):
+    source = tmp_path / "dir"
+    (source / "sub").mkdir(parents=True)
+    (source / "a.txt").write_text("a" * 1000)
+    (source / "sub" / "b.bin").write_bytes(os.urandom(5000))
+    os.chmod(source / "a.txt", 0o600)
+    port = free_port()
+    send = aio.send_file("127.0.0.1", port, str(source))
+    result, error = asyncio.run(receive(port, str(tmp_path / "out"), send))
+    assert error is None
+    assert result["validated"]
+    received = tmp_path / "out" / "dir"
+    assert (received / "a.txt").read_text() == "a" * 1000
+    assert (received / "sub" / "b.bin").read_bytes() == (
+        source / "sub" / "b.bin"
+    ).read_bytes()
+    assert os.stat(received / "a.txt").st_mode & 0o777 == 0o600
+
+
+def test_short_file_is_rejected(tmp_path):
+    port = free_port()
+    metadata = {
+        "name": "short.bin",
+        "size": 100,
+        "hash": None,
+        "hash_algo": "none",
+        "is_dir": False,
+        "compress": "none",
+    }
+
+    async def send():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await aio.send_json(writer, protocol.METADATA, metadata)
+        await aio.recv_json(reader, protocol.ACK)
+        await aio.send_frame(writer, protocol.DATA, b"x" * 50)
+        await aio.send_json(writer, protocol.TRAILER, {"hash_algo": "none"})
+        try:
+            return await aio.recv_json(reader, protocol.ACK)
+        except protocol.RemoteError as e:
+            return e
+        finally:
+            writer.close()
+
+    result, error = asyncio.run(receive(port, str(tmp_path), send()))
+    assert "Received 50 bytes but expected 100." in error
+    assert isinstance(result, protocol.RemoteError)
+
+
+def test_paths_outside_the_save_directory_are_refused(tmp_path):
+    port = free_port()
+    entry = {"path": "../escape.txt", "type": "file", "size": 3, "mode": 0o644}
+    metadata = {
+        "name": "dir",
+        "size": 3,
+        "hash": None,
+        "hash_algo": "none",
+        "is_dir": True,
+        "archive": "manifest",
+        "compress": "none",
+        "manifest": [entry],
+    }
+
+    async def send():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        await aio.send_json(writer, protocol.METADATA, metadata)
+        await aio.recv_json(reader, protocol.ACK)
+        await aio.send_frame(writer, protocol.DATA, b"abc")
+        try:
+            return await aio.recv_json(reader, protocol.ACK)
+        except protocol.RemoteError as e:
+            return e
+        finally:
+            writer.close()
+
+    with pytest.raises(protocol.ProtocolError, match="Refusing to write outside"):
+        asyncio.run(receive(port, str(tmp_path / "out"), send()))
+    assert not (tmp_path / "escape.txt").exists()
+
+
+def test_receive_file_accepts_one_sender(tmp_path):
+    source = tmp_path / "data.bin"
+    source.write_bytes(os.urandom(1024 * 64))
+    port = free_port()
+
+    async def send():
+        # the first sender holds the transfer open until the second is turned away
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            await asyncio.sleep(0.1)
+            second = aio.send_file("127.0.0.1", port, str(source))
+            with pytest.raises(protocol.RemoteError, match="busy"):
+                await second
+        finally:
+            writer.close()
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(receive(port, str(tmp_path / "out"), send()))
+    assert not (tmp_path / "out" / "data.bin").exists()
@@ -0,0 +1,28 @@
+from nx.core import dedup
+
+
+def put(store, data):
+    digest = dedup.chunk_hash(data)
+    store.put(digest, data)
+    return digest
+
+
+def test_store_is_capped_while_chunks_are_put(tmp_path):
+    store = dedup.ChunkStore(str(tmp_path), max_size=3000)
+    digests = [put(store, bytes([i]) * 1000) for i in range(5)]
+    assert store.size <= 3000
+    assert [store.has(digest) for digest in digests] == [False, False, True, True, True]
+
+
+def test_pinned_chunks_are_not_evicted(tmp_path):
+    store = dedup.ChunkStore(str(tmp_path), max_size=2000)
+    first = put(store, b"a" * 1000)
+    store.pin([first])
+    for i in range(5):
+        put(store, bytes([i]) * 1000)
+    assert store.has(first)
+    store.unpin([first])
+    assert store.size <= 2000
+
+    # a new store finds the chunks left on disk
+    assert dedup.ChunkStore(str(tmp_path), max_size=2000).has(first)
@@ -0,0 +1,18 @@
+import pytest
+
+from nx.core import delta, protocol
+from nx.core.tcp_transfer import read_blocks
+
+
+def test_block_references_are_bounded(tmp_path):
+    path = tmp_path / "basis.bin"
+    block = 1024 * 4
+    path.write_bytes(bytes(block * 300 + 100))
+    basis = read_blocks(str(path), block)
+    max_run = delta.MAX_RUN_BYTES // block
+
+    assert len(basis(0, max_run)) == max_run * block
+    assert len(basis(299, 1)) == block
+    for index, count in [(0, max_run + 1), (299, 2), (300, 1), (2**40, 2**31)]:
+        with pytest.raises(protocol.ProtocolError):
+            basis(index, count)
@@ -0,0 +1,11 @@
+from nx.core import progress
+
+
+def test_last_count_is_always_reported():
+    reports = list(progress.throttle([10, 20, 30], 30, interval=60))
+    assert [report["current"] for report in reports] == [30]
+
+
+def test_transfers_without_data_are_not_reported():
+    assert list(progress.throttle([0, 0], 0)) == []
+    assert progress.ProgressReporter(0).update(0, force=True) is None
@@ -0,0 +1,42 @@
+import socket
+
+import pytest
+
+from nx.core import compression, protocol
+
+
+def test_oversized_frames_are_rejected():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        length = protocol.MAX_CONTROL_FRAME + 1
+        sender.sendall(protocol.pack_header(protocol.METADATA, length))
+        with pytest.raises(protocol.ProtocolError):
+            protocol.recv_json(receiver, protocol.METADATA)
+
+        length = protocol.MAX_COMPRESSED_FRAME + 1
+        sender.sendall(protocol.pack_header(protocol.DATA, length, protocol.COMPRESSED))
+        frame_type, flags, length = protocol.recv_header(receiver)
+        with pytest.raises(protocol.ProtocolError):
+            protocol.iter_data(receiver, flags, length, 1024, bytes)
+
+
+def test_json_payload_must_be_an_object():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        protocol.send_frame(sender, protocol.METADATA, b"[1, 2]")
+        with pytest.raises(protocol.ProtocolError):
+            protocol.recv_json(receiver, protocol.METADATA)
+
+
+def test_decompressed_size_is_capped():
+    sender, receiver = socket.socketpair()
+    with sender, receiver:
+        for codec in compression.available_codecs():
+            payload, _ = compression.Compressor(codec).compress(
+                b"x" * (compression.COMPRESS_BLOCK + 1)
+            )
+            protocol.send_frame(sender, protocol.DATA, payload, protocol.COMPRESSED)
+            _, flags, length = protocol.recv_header(receiver)
+            decompress = compression.new_decompressor(codec)
+            with pytest.raises(protocol.ProtocolError):
+                protocol.iter_data(receiver, flags, length, 1024, decompress)